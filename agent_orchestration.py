@@ -1,3 +1,4 @@
+import asyncio
 import os
 from langgraph.graph import StateGraph, END
 
@@ -19,10 +20,12 @@ graph.add_node("test_coverage", test_coverage_agent)
 graph.add_node("doc_summarizer", doc_summarizer_agent)
 
 # Define workflow edges
+# code_review and test_coverage only depend on the fetched files, so they run
+# in parallel and doc_summarizer waits for both branches to finish.
 graph.set_entry_point("pr_fetcher")
 graph.add_edge("pr_fetcher", "code_review")
-graph.add_edge("code_review", "test_coverage")
-graph.add_edge("test_coverage", "doc_summarizer")
+graph.add_edge("pr_fetcher", "test_coverage")
+graph.add_edge(["code_review", "test_coverage"], "doc_summarizer")
 graph.add_edge("doc_summarizer", END)
 
 # Compile workflow
@@ -55,8 +58,8 @@ if __name__ == "__main__":
         custom_guidelines=custom_guidelines_content
     )
 
-    # Invoke workflow
-    result = workflow.invoke(state)
+    # Invoke workflow (code review node is async, so use the async entrypoint)
+    result = asyncio.run(workflow.ainvoke(state))
 
     # --------------------------
     # Print PR info
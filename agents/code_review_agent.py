@@ -1,13 +1,42 @@
+import asyncio
+import hashlib
+import io
 import json
 import os
+import re
+import threading
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
 from dotenv import load_dotenv
+from agents.llm_cache import LLMCache, get_llm_cache
 from agents.llm_client import get_llm_client
+from agents.progress import progress_writer
 from agents.prompt_loader import load_prompt
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
 from agents.state import CodeReviewAgentState
 
+# Optional C-accelerated multi-keyword matcher for static checks
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# Optional faster JSON parser for LLM output (orjson.JSONDecodeError subclasses
+# json.JSONDecodeError, so error handling is the same either way)
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+# Optional tokenizer for trimming patches to the prompt token budget
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
 # RAG imports
 try:
     from agents.rag_retriever import get_rag_retriever
@@ -18,6 +47,19 @@ except ImportError:
 
 load_dotenv()
 
+
+def _warm_rag_retriever() -> None:
+    """Create the RAG retriever (Chroma client, embedding client) ahead of the first review."""
+    try:
+        get_rag_retriever()
+    except Exception as e:
+        print(f"⚠️ RAG warm-up failed: {e}")
+
+
+# Build the retriever in the background while the PR is being fetched
+if RAG_ENABLED:
+    threading.Thread(target=_warm_rag_retriever, name="rag-warmup", daemon=True).start()
+
 # --------------------------
 # Paths & configuration loading
 # --------------------------
@@ -30,10 +72,9 @@ EXTENDED_RULES_PATH = BASE_DIR / "extended_rules.md"
 def _load_global_rules() -> List[Dict[str, Any]]:
     """Load global review rules from JSON file."""
     try:
-        with GLOBAL_RULES_PATH.open("r", encoding="utf-8") as f:
-            data = json.load(f)
-            if isinstance(data, list):
-                return data
+        data = _json_loads(GLOBAL_RULES_PATH.read_bytes())
+        if isinstance(data, list):
+            return data
     except FileNotFoundError:
         pass
     except json.JSONDecodeError:
@@ -44,8 +85,7 @@ def _load_global_rules() -> List[Dict[str, Any]]:
 def _load_extended_rules() -> str:
     """Load extended coding rules and best practices from markdown file."""
     try:
-        with EXTENDED_RULES_PATH.open("r", encoding="utf-8") as f:
-            return f.read()
+        return EXTENDED_RULES_PATH.read_text(encoding="utf-8")
     except FileNotFoundError:
         return ""
 
@@ -59,19 +99,15 @@ def _format_global_rules_for_prompt(rules: List[Dict[str, Any]]) -> str:
     if not rules:
         return "No specific global rules configured."
 
-    lines: List[str] = ["\n**Global Review Rules:**\n"]
-    for rule in rules:
-        rule_id = rule.get("id", "R?")
-        title = rule.get("title", "").strip()
-        severity = rule.get("severity", "").upper()
-        description = rule.get("description", "").strip()
-        fix = rule.get("fix", "").strip()
-
-        lines.append(f"- **[{rule_id}]** ({severity}) {title}")
-        lines.append(f"  - {description}")
-        lines.append(f"  - Fix: {fix}")
-        lines.append("")
-    return "\n".join(lines)
+    # One block per rule, each ending in a newline so rules are blank-line separated
+    parts: List[str] = ["\n**Global Review Rules:**\n"]
+    parts.extend(
+        f"- **[{rule.get('id', 'R?')}]** ({rule.get('severity', '').upper()}) {rule.get('title', '').strip()}\n"
+        f"  - {rule.get('description', '').strip()}\n"
+        f"  - Fix: {rule.get('fix', '').strip()}\n"
+        for rule in rules
+    )
+    return "\n".join(parts)
 
 
 # --------------------------
@@ -79,8 +115,76 @@ def _format_global_rules_for_prompt(rules: List[Dict[str, Any]]) -> str:
 # --------------------------
 client = get_llm_client(convert_system_message_to_human=True)
 
-# Load main prompt template from prompts folder
+# Load prompt templates from prompts folder. The system prompt holds everything
+# that is invariant across files of one language (instructions, rules, guidelines)
+# so providers can reuse the cached prefix; the per-file prompt only carries the
+# filename, RAG context and patch.
+SYSTEM_PROMPT_TEMPLATE = load_prompt("code_review_system_prompt.txt")
 PROMPT_TEMPLATE = load_prompt("code_review_prompt.txt")
+MULTI_PROMPT_TEMPLATE = load_prompt("code_review_multi_prompt.txt")
+
+# Maximum number of in-flight LLM review requests per PR (respects provider rate limits)
+MAX_REVIEW_CONCURRENCY = int(os.getenv("REVIEW_CONCURRENCY", "8"))
+
+# Stream review responses and stop reading as soon as the JSON answer is complete
+STREAM_REVIEWS = os.getenv("PULLPAL_STREAM_REVIEWS", "1") == "1"
+
+# Review up to this many same-language files per LLM call (1 = one call per file)
+FILES_PER_LLM_CALL = int(os.getenv("PULLPAL_FILES_PER_CALL", "1"))
+# Upper bound on the combined patch size of one grouped call (characters)
+MAX_GROUP_PATCH_CHARS = int(os.getenv("PULLPAL_GROUP_MAX_CHARS", "20000"))
+
+# Patches adding fewer lines than this only get the static checks (unless those flag something)
+MIN_LLM_ADDED_LINES = int(os.getenv("PULLPAL_MIN_LLM_LINES", "3"))
+
+# Token budget for the patch inside one review prompt (longer patches are cut at a line boundary)
+MAX_PROMPT_TOKENS = int(os.getenv("MAX_PROMPT_TOKENS", "6000"))
+
+# Unchanged lines kept around each change when compacting a patch for the prompt
+PATCH_CONTEXT_LINES = int(os.getenv("PULLPAL_PATCH_CONTEXT", "2"))
+
+# Patches larger than this (UTF-8 bytes) are reported as too large and not reviewed at all
+MAX_PATCH_BYTES = int(os.getenv("MAX_PATCH_BYTES", "200000"))
+
+# Generated, vendored and lock files are never worth an LLM round trip
+SKIP_LLM_PATTERNS = [re.compile(p) for p in (
+    r"(^|/)vendor/",
+    r"(^|/)node_modules/",
+    r"\.min\.(js|css)$",
+    r"(^|/)package-lock\.json$",
+    r"(^|/)yarn\.lock$",
+    r"\.generated\.",
+)]
+
+# Line prefixes treated as comments when detecting comment-only changes, per
+# language (see LANGUAGE_MAP). "#" and "--" only mean a comment in some
+# languages (C's #include, Rust's #[derive], a leading --count), and languages
+# missing here are never skipped as comment-only.
+_C_STYLE_COMMENTS = ("//", "/*", "* ", "*/")
+_COMMENT_PREFIXES = {
+    "Python": ("#",),
+    "Ruby": ("#",),
+    "Shell/Bash": ("#",),
+    "YAML": ("#",),
+    "Java": _C_STYLE_COMMENTS,
+    "JavaScript": _C_STYLE_COMMENTS,
+    "JavaScript (React)": _C_STYLE_COMMENTS,
+    "TypeScript": _C_STYLE_COMMENTS,
+    "TypeScript (React)": _C_STYLE_COMMENTS,
+    "Go": _C_STYLE_COMMENTS,
+    "PHP": _C_STYLE_COMMENTS,
+    "C#": _C_STYLE_COMMENTS,
+    "C++": _C_STYLE_COMMENTS,
+    "C": _C_STYLE_COMMENTS,
+    "Rust": _C_STYLE_COMMENTS,
+    "Kotlin": _C_STYLE_COMMENTS,
+    "Swift": _C_STYLE_COMMENTS,
+    "Scala": _C_STYLE_COMMENTS,
+    "CSS": ("/*", "* ", "*/"),
+    "SQL": ("--", "/*", "* ", "*/"),
+    "HTML": ("<!--",),
+    "XML": ("<!--",),
+}
 
 # --------------------------
 # Language detection and best practices
@@ -156,6 +260,18 @@ LANGUAGE_BEST_PRACTICES = {
     ],
 }
 
+# Best-practices block per language, with the (constant) extended and global
+# rules appended, rendered once at import instead of once per file
+_RULES_SUFFIX = (
+    (f"\n\n**Extended Best Practices:**\n{EXTENDED_RULES}" if EXTENDED_RULES else "")
+    + _format_global_rules_for_prompt(GLOBAL_RULES)
+)
+_DEFAULT_PROMPT_BLOCK = "Follow general coding standards." + _RULES_SUFFIX
+LANGUAGE_PROMPT_BLOCK = {
+    lang: "\n".join(f"- {bp}" for bp in bps) + _RULES_SUFFIX
+    for lang, bps in LANGUAGE_BEST_PRACTICES.items()
+}
+
 # --------------------------
 # Static keyword-based issue detection (language-agnostic)
 # --------------------------
@@ -183,6 +299,72 @@ STATIC_ISSUES = {
 }
 
 
+def _build_static_findings() -> Dict[str, Mapping[str, Any]]:
+    """
+    Pre-enrich each STATIC_ISSUES entry with its matching global rule (if any).
+
+    Entries are read-only views: findings must be copied with dict() before
+    being handed out, so per-file enrichment can never leak into module state.
+    """
+    static_findings = {}
+    for keyword, issue in STATIC_ISSUES.items():
+        # Attach rule details if available from global rules
+        rule_detail = None
+        for gr in GLOBAL_RULES:
+            if keyword.lower() in gr.get("title", "").lower() or keyword.lower() in gr.get("description", "").lower():
+                rule_detail = gr
+                break
+        enriched_issue = {**issue, "source": "global"}
+        if rule_detail:
+            enriched_issue.update({
+                "rule_id": rule_detail.get("id"),
+                "rule_title": rule_detail.get("title"),
+                "rule_description": rule_detail.get("description"),
+                "rule_fix": rule_detail.get("fix")
+            })
+        static_findings[keyword] = MappingProxyType(enriched_issue)
+    return static_findings
+
+
+def _build_static_matcher():
+    """
+    Compile all STATIC_ISSUES keywords into a single matcher so each patch is
+    scanned once, regardless of how many keywords there are.
+
+    Returns:
+        callable: Function mapping a patch to the set of keywords found in it.
+    """
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for keyword in STATIC_ISSUES:
+            automaton.add_word(keyword, keyword)
+        automaton.make_automaton()
+        return lambda patch: {keyword for _, keyword in automaton.iter(patch)}
+
+    # Fallback: one regex alternation (longest keywords first), still a single pass
+    keywords = sorted(STATIC_ISSUES, key=len, reverse=True)
+    pattern = re.compile("|".join(re.escape(k) for k in keywords))
+    return lambda patch: set(pattern.findall(patch))
+
+
+STATIC_FINDINGS = _build_static_findings()
+_find_static_keywords = _build_static_matcher()
+
+
+# Diff hunk header, e.g. "@@ -15,7 +15,8 @@"; group 1 is the new-file start line
+_HUNK_HEADER_RE = re.compile(r'@@ -\d+,?\d* \+(\d+),?(\d*) @@')
+
+# Tokens that matter when scanning for a JSON array/object: string literals
+# (skipped whole, escapes included), brackets and braces
+_JSON_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]{}]', re.DOTALL)
+
+
+@lru_cache(maxsize=256)
+def _lang_from_ext(ext: str) -> str:
+    """Map a lower-cased file extension to its language name (memoized)."""
+    return LANGUAGE_MAP.get(ext, "Unknown")
+
+
 def get_file_language(filename: str) -> str:
     """
     Detect programming language from file extension.
@@ -193,97 +375,142 @@ def get_file_language(filename: str) -> str:
     Returns:
         str: Language name or "Unknown"
     """
-    import os
-    _, ext = os.path.splitext(filename.lower())
-    return LANGUAGE_MAP.get(ext, "Unknown")
+    return _lang_from_ext(os.path.splitext(filename)[1].lower())
 
 
-def extract_code_context(patch: str, issue_keywords: list = None) -> dict:
+def iter_added_lines(patch: str) -> Iterator[Dict[str, Any]]:
     """
-    Extract code snippets with line numbers from a diff patch.
+    Lazily yield added lines with their new-file line numbers from a diff patch.
     
     Args:
         patch (str): The diff patch content
-        issue_keywords (list): Optional keywords to find relevant sections
         
-    Returns:
-        dict: Dictionary with line ranges and code snippets
+    Yields:
+        dict: {"line_number", "type": "added", "code"} for each added line
     """
-    lines = patch.splitlines()
-    code_blocks = []
     current_line = 0
     
-    for i, line in enumerate(lines):
-        # Parse diff hunk headers like @@ -15,7 +15,8 @@
-        if line.startswith("@@"):
-            import re
-            match = re.search(r'@@ -\d+,?\d* \+(\d+),?(\d*) @@', line)
+    for line in io.StringIO(patch):
+        line = line.rstrip("\r\n")
+        # Dispatch on the first character once instead of chained startswith() calls
+        c0 = line[:1]
+        if c0 == "@":
+            # Parse diff hunk headers like @@ -15,7 +15,8 @@
+            match = _HUNK_HEADER_RE.match(line)
             if match:
                 current_line = int(match.group(1))
-        elif line.startswith("+") and not line.startswith("+++"):
+        elif c0 == "+":
+            if line[:3] == "+++":
+                continue
             # Added line
-            code_line = line[1:]  # Remove the '+'
-            code_blocks.append({
+            yield {
                 "line_number": current_line,
                 "type": "added",
-                "code": code_line
-            })
+                "code": line[1:]  # Remove the '+'
+            }
             current_line += 1
-        elif line.startswith("-") and not line.startswith("---"):
-            # Removed line (don't increment line number)
+        elif c0 == "-" or c0 == "\\":
+            # Removed line or "\ No newline" marker (don't increment line number)
             pass
-        elif not line.startswith("\\"):
+        else:
             # Context line
             current_line += 1
+
+
+def extract_code_context(patch: str, issue_keywords: list = None) -> list:
+    """
+    Extract code snippets with line numbers from a diff patch.
+    
+    Args:
+        patch (str): The diff patch content
+        issue_keywords (list): Optional keywords to find relevant sections
+        
+    Returns:
+        list: Added line dicts, see iter_added_lines()
+    """
+    return list(iter_added_lines(patch))
+
+
+def iter_code_sections(code_blocks: Iterable[Dict[str, Any]], context_lines: int = 3) -> Iterator[Dict[str, Any]]:
+    """
+    Lazily group code blocks into continuous sections with context.
+    
+    Args:
+        code_blocks (iterable): Code line dicts, e.g. from iter_added_lines()
+        context_lines (int): Number of context lines to include
+        
+    Yields:
+        dict: {"start_line", "end_line", "lines"} for each section
+    """
+    start = end = None
+    lines: List[Dict[str, Any]] = []
     
-    return code_blocks
+    for block in code_blocks:
+        line_number = block["line_number"]
+        # Start a new section once the gap exceeds the context range
+        if lines and line_number - end > context_lines + 1:
+            yield {"start_line": start, "end_line": end, "lines": lines}
+            lines = []
+        if not lines:
+            start = line_number
+        end = line_number
+        lines.append(block)
+    
+    # Emit the last section
+    if lines:
+        yield {"start_line": start, "end_line": end, "lines": lines}
 
 
-def group_code_by_context(code_blocks: list, context_lines: int = 3) -> list:
+def group_code_by_context(code_blocks: Iterable[Dict[str, Any]], context_lines: int = 3) -> list:
     """
     Group code blocks into continuous sections with context.
     
     Args:
-        code_blocks (list): List of code line dicts
+        code_blocks (iterable): Code line dicts (list or generator)
         context_lines (int): Number of context lines to include
         
     Returns:
         list: List of grouped code sections
     """
-    if not code_blocks:
-        return []
-    
-    sections = []
-    current_section = {
-        "start_line": code_blocks[0]["line_number"],
-        "end_line": code_blocks[0]["line_number"],
-        "lines": [code_blocks[0]]
-    }
-    
-    for block in code_blocks[1:]:
-        # If within context range, extend current section
-        if block["line_number"] - current_section["end_line"] <= context_lines + 1:
-            current_section["end_line"] = block["line_number"]
-            current_section["lines"].append(block)
+    return list(iter_code_sections(code_blocks, context_lines))
+
+
+def _iter_json_spans(text: str, open_char: str = "[", close_char: str = "]") -> Iterator[str]:
+    """
+    Yield candidate top-level JSON array (or object) substrings, found by bracket depth.
+
+    Brackets inside JSON string literals (e.g. code snippets like "a[0]") are
+    skipped, so they cannot unbalance the scan.
+
+    Args:
+        text (str): Text that may contain JSON surrounded by prose.
+        open_char (str): "[" for arrays, "{" for objects.
+        close_char (str): The matching closing character.
+
+    Yields:
+        str: Each balanced span, in order of appearance.
+    """
+    start = text.find(open_char)
+    while start != -1:
+        depth = 0
+        for token in _JSON_TOKEN_RE.finditer(text, start):
+            if token.group() == open_char:
+                depth += 1
+            elif token.group() == close_char:
+                depth -= 1
+                if depth == 0:
+                    yield text[start:token.end()]
+                    break
         else:
-            # Start new section
-            sections.append(current_section)
-            current_section = {
-                "start_line": block["line_number"],
-                "end_line": block["line_number"],
-                "lines": [block]
-            }
-    
-    # Add the last section
-    sections.append(current_section)
-    
-    return sections
+            # Unbalanced to the end of the text, nothing more to find
+            return
+        start = text.find(open_char, token.end())
 
 
 def safe_parse_json(raw_text: str, filename: str) -> list:
     """
     Safely parse JSON from LLM output.
-    Falls back to extracting the first valid JSON array if needed.
+    Falls back to extracting the first well-formed JSON array if needed.
 
     Args:
         raw_text (str): Raw text output from LLM.
@@ -294,166 +521,908 @@ def safe_parse_json(raw_text: str, filename: str) -> list:
     """
     raw_text = raw_text.strip()
     try:
-        return json.loads(raw_text)
+        return _json_loads(raw_text)
     except json.JSONDecodeError:
-        # Try to extract JSON array from text
-        start = raw_text.find("[")
-        end = raw_text.rfind("]") + 1
-        if start != -1 and end != -1:
+        # Try each balanced array in the text (handles nested arrays and trailing prose)
+        for candidate in _iter_json_spans(raw_text):
             try:
-                return json.loads(raw_text[start:end])
+                return _json_loads(candidate)
             except json.JSONDecodeError:
-                print(f"⚠️ Still invalid JSON for {filename}")
+                continue
         print(f"⚠️ Invalid JSON output for {filename}: {raw_text[:200]}...")
         return []
 
 
-def code_review_agent(state: CodeReviewAgentState) -> CodeReviewAgentState:
+def _parse_grouped_output(raw_text: str, filenames: List[str]) -> Dict[str, list]:
+    """
+    Parse the {filename: [issues]} object returned for a grouped review.
+
+    Args:
+        raw_text (str): Raw text output from LLM.
+        filenames (list): Files that were part of the grouped prompt.
+
+    Returns:
+        dict: Issue lists for the files the LLM answered for; missing or
+        malformed entries are left out so the caller can retry them.
+    """
+    raw_text = raw_text.strip()
+    candidates = [raw_text, *_iter_json_spans(raw_text, "{", "}")]
+    for candidate in candidates:
+        try:
+            data = _json_loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(data, dict):
+            wanted = set(filenames)
+            return {name: issues for name, issues in data.items()
+                    if name in wanted and isinstance(issues, list)}
+    return {}
+
+
+def _static_findings(patch: str) -> List[Dict[str, Any]]:
+    """
+    Run keyword-based and size-based static checks on a patch.
+
+    Args:
+        patch (str): The diff patch content.
+
+    Returns:
+        list: Static issue dicts found in the patch.
+    """
+    # One scan for all keywords; report hits in STATIC_ISSUES order, once each
+    hits = _find_static_keywords(patch)
+    file_findings = [dict(STATIC_FINDINGS[keyword]) for keyword in STATIC_ISSUES if keyword in hits]
+
+    # Detect large files/functions (count newlines instead of materializing every line)
+    if patch.count("\n") + (not patch.endswith("\n")) > 200:
+        file_findings.append({
+            "type": "performance",
+            "message": "Large file/function detected (>200 lines).",
+            "suggestion": "Split into smaller, modular functions.",
+            "source": "global",
+            "rule_id": "PERF-001",
+            "rule_title": "Large file/function",
+            "rule_description": "Files or functions should not exceed 200 lines for maintainability.",
+            "rule_fix": "Refactor into smaller, modular functions."
+        })
+
+    return file_findings
+
+
+def _llm_skip_reason(filename: str, patch: str, has_static_hits: bool = False) -> Optional[str]:
+    """
+    Decide whether a file's patch can skip the LLM review.
+
+    Args:
+        filename (str): Name of the file.
+        patch (str): The diff patch content.
+        has_static_hits (bool): Static checks flagged the patch; small patches
+            are then still sent to the LLM for a closer look.
+
+    Returns:
+        str: Reason for skipping, or None if the file should be reviewed.
+    """
+    if any(pattern.search(filename) for pattern in SKIP_LLM_PATTERNS):
+        return "generated or vendored file"
+
+    # Unknown languages: every non-blank line counts as code
+    comment_prefixes = _COMMENT_PREFIXES.get(get_file_language(filename))
+    added = substantive = 0
+    for block in iter_added_lines(patch):
+        added += 1
+        code = block["code"].strip()
+        if code and not (comment_prefixes and code.startswith(comment_prefixes)):
+            substantive += 1
+    if added < MIN_LLM_ADDED_LINES and not has_static_hits:
+        return f"only {added} added line(s)"
+    if not substantive:
+        return "whitespace/comment-only change"
+    return None
+
+
+def _dedup_key(language: str, patch: str) -> bytes:
+    """Hash a (language, patch) pair so identical diffs in one PR share an LLM call."""
+    return hashlib.blake2b(f"{language}\x00{patch}".encode("utf-8"), digest_size=16).digest()
+
+
+@lru_cache(maxsize=64)
+def _build_system_prompt(language: str, custom_guidelines: Optional[str]) -> str:
+    """
+    Build the system prompt shared by every file of the given language.
+
+    Nothing file-specific may go in here: identical bytes across calls are what
+    lets providers serve the prefix from their prompt cache. The result is
+    memoized, so each (language, guidelines) pair is rendered once.
+
+    Args:
+        language (str): Detected language of the files.
+        custom_guidelines (str, optional): User-provided project guidelines.
+
+    Returns:
+        str: The system prompt.
+    """
+    custom_guidelines_section = f"\n\n**Custom Project Guidelines:**\n{custom_guidelines}" if custom_guidelines else "\nNo custom guidelines provided."
+
+    return SYSTEM_PROMPT_TEMPLATE.format(
+        language=language,
+        best_practices_text=LANGUAGE_PROMPT_BLOCK.get(language, _DEFAULT_PROMPT_BLOCK),
+        custom_guidelines_section=custom_guidelines_section
+    )
+
+
+def _added_code(patch: str, max_chars: int = 500) -> str:
+    """
+    Collect the added code of a patch, without diff markers, as a RAG search query.
+
+    Args:
+        patch (str): The diff patch content.
+        max_chars (int): Maximum length of the returned text.
+
+    Returns:
+        str: Added lines joined by newlines, at most max_chars long.
+    """
+    parts: List[str] = []
+    size = 0
+    for block in iter_added_lines(patch):
+        parts.append(block["code"])
+        size += len(block["code"]) + 1
+        if size >= max_chars:
+            break
+    return "\n".join(parts)[:max_chars]
+
+
+@lru_cache(maxsize=1)
+def _token_encoding():
+    """Return the tiktoken encoding used to measure prompts, or None if unavailable."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+def _truncate_patch(patch: str, max_tokens: int = MAX_PROMPT_TOKENS) -> str:
+    """
+    Trim a patch to the prompt token budget, cutting at a line boundary.
+
+    Args:
+        patch (str): The diff patch content.
+        max_tokens (int): Token budget for the patch.
+
+    Returns:
+        str: The patch, or its head plus a truncation marker.
+    """
+    encoding = _token_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(patch, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return patch
+        cut = len(encoding.decode(tokens[:max_tokens]))
+    else:
+        # Roughly 4 characters per token for code
+        cut = max_tokens * 4
+        if len(patch) <= cut:
+            return patch
+
+    newline = patch.rfind("\n", 0, cut)
+    return patch[:newline if newline > 0 else cut] + "\n... (patch truncated for review)"
+
+
+def _minify_patch(patch: str, context_lines: int = PATCH_CONTEXT_LINES) -> str:
+    """
+    Compact a patch for the prompt without losing line numbers.
+
+    Unchanged lines further than context_lines from any change are dropped and
+    hunk headers are replaced by an "L<n>:" marker giving the new-file line
+    number of the line that follows. Every run of kept lines gets such a marker.
+
+    Args:
+        patch (str): The diff patch content.
+        context_lines (int): Unchanged lines to keep before and after each change.
+
+    Returns:
+        str: The compacted patch.
+    """
+    # (first char, new-file line number, line) per diff line; None marks a hunk break
+    entries: List[Optional[Tuple[str, int, str]]] = []
+    current_line = 0
+    for line in io.StringIO(patch):
+        line = line.rstrip("\r\n")
+        c0 = line[:1]
+        if c0 == "@":
+            match = _HUNK_HEADER_RE.match(line)
+            if match:
+                current_line = int(match.group(1))
+                entries.append(None)
+        elif c0 == "\\" or (not entries and line[:3] in ("+++", "---")):
+            # "\ No newline" markers, and file headers of full diffs (only
+            # before the first hunk: inside one, "+++i;" is an added line)
+            continue
+        else:
+            entries.append((c0, current_line, line))
+            # Removed lines don't exist in the new file
+            if c0 != "-":
+                current_line += 1
+
+    # Keep every change plus its surrounding context
+    keep = [False] * len(entries)
+    for idx, entry in enumerate(entries):
+        if entry is not None and entry[0] in ("+", "-"):
+            for near in range(max(0, idx - context_lines), min(len(entries), idx + context_lines + 1)):
+                keep[near] = True
+
+    out: List[str] = []
+    in_run = False
+    for entry, kept in zip(entries, keep):
+        if entry is None or not kept:
+            in_run = False
+            continue
+        if not in_run:
+            out.append(f"L{entry[1]}:")
+            in_run = True
+        out.append(entry[2])
+    return "\n".join(out)
+
+
+def _build_review_messages(filename: str, language: str, patch: str,
+                           custom_guidelines: Optional[str],
+                           project_name: Optional[str],
+                           rag_context: Optional[str] = None) -> Tuple[List[BaseMessage], str]:
+    """
+    Build the LLM review messages for a single file, including RAG context.
+
+    Args:
+        filename (str): Name of the file under review.
+        language (str): Detected language of the file.
+        patch (str): The diff patch content.
+        custom_guidelines (str, optional): User-provided project guidelines.
+        project_name (str, optional): "owner/repo" used to filter RAG guidelines.
+        rag_context (str, optional): Context already retrieved by
+            _prefetch_rag_contexts(); None to retrieve it here.
+
+    Returns:
+        tuple: (messages, rag_context) where rag_context is "" if nothing was retrieved.
+    """
+    # 🆕 RAG: Retrieve relevant context from vector database (unless prefetched)
+    if rag_context is None:
+        rag_context = ""
+        if RAG_ENABLED:
+            try:
+                retriever = get_rag_retriever()
+
+                # Get relevant context based on the code patch
+                context = retriever.get_relevant_context(
+                    code_snippet=_added_code(patch),
+                    language=language,
+                    project_name=project_name,
+                    max_rules=5,
+                    max_guidelines=3
+                )
+
+                # Format context for prompt
+                rag_context = retriever.format_context_for_prompt(context)
+                if rag_context:
+                    print(f"  🔍 RAG: Retrieved {len(context.get('rules', []))} rules + {len(context.get('guidelines', []))} guidelines")
+            except Exception as e:
+                print(f"  ⚠️ RAG retrieval failed: {e}")
+
+    compact_patch = _minify_patch(patch)
+    prompt_patch = _truncate_patch(compact_patch)
+    if prompt_patch is not compact_patch:
+        print(f"  ✂️ Patch for {filename} truncated to ~{MAX_PROMPT_TOKENS} tokens")
+
+    # RAG context depends on the patch, so it belongs to the per-file tail
+    prompt = PROMPT_TEMPLATE.format(
+        filename=filename,
+        rag_context="\n" + rag_context + "\n" if rag_context else "",
+        patch=prompt_patch
+    )
+    messages = [
+        SystemMessage(content=_build_system_prompt(language, custom_guidelines)),
+        HumanMessage(content=prompt),
+    ]
+    return messages, rag_context
+
+
+def _prefetch_rag_contexts(files: List[Dict[str, Any]],
+                           project_name: Optional[str]) -> Optional[Dict[str, str]]:
+    """
+    Retrieve RAG context for every reviewable file with one batched lookup.
+
+    Args:
+        files (list): Parsed PR files with non-empty patches.
+        project_name (str, optional): "owner/repo" used to filter RAG guidelines.
+
+    Returns:
+        dict: Formatted RAG context per filename ("" if nothing relevant), or
+        None when RAG is unavailable or the lookup failed, in which case
+        prompts fall back to per-file retrieval.
+    """
+    if not RAG_ENABLED:
+        return None
+
+    targets = [(f, get_file_language(f["filename"])) for f in files]
+    targets = [(f, language) for f, language in targets if language != "Unknown"]
+    if not targets:
+        return {}
+
+    try:
+        retriever = get_rag_retriever()
+        contexts = retriever.get_relevant_context_batch(
+            code_snippets=[_added_code(f.get("patch", "")) for f, _ in targets],
+            languages=[language for _, language in targets],
+            project_name=project_name,
+            max_rules=5,
+            max_guidelines=3
+        )
+    except Exception as e:
+        print(f"  ⚠️ RAG retrieval failed: {e}")
+        return None
+
+    rag_contexts = {}
+    for (f, _), context in zip(targets, contexts):
+        rag_contexts[f["filename"]] = retriever.format_context_for_prompt(context)
+    retrieved = sum(1 for rag_context in rag_contexts.values() if rag_context)
+    print(f"  🔍 RAG: Retrieved context for {retrieved}/{len(targets)} file(s) in one batch")
+    return rag_contexts
+
+
+def _build_group_messages(reviews: List[Dict[str, Any]]) -> List[BaseMessage]:
+    """
+    Combine the prompts of several same-language files into one LLM request.
+
+    The system prompt is shared by every file of a language, and each file
+    keeps its own per-file prompt (patch and RAG context) as one section.
+
+    Args:
+        reviews (list): Prepared reviews of the same language.
+
+    Returns:
+        list: [SystemMessage, HumanMessage] for the grouped request.
+    """
+    file_sections = "\n\n".join(
+        f"--- File {idx}: {review['filename']} ---\n{review['messages'][1].content}"
+        for idx, review in enumerate(reviews, 1)
+    )
+    return [
+        reviews[0]["messages"][0],
+        HumanMessage(content=MULTI_PROMPT_TEMPLATE.format(count=len(reviews), file_sections=file_sections)),
+    ]
+
+
+def _enrich_llm_issues(llm_issues: list, filename: str, patch: str,
+                       custom_guidelines: Optional[str], rag_context: str) -> list:
+    """
+    Fill in filename, line numbers, code snippets and source tags on LLM issues.
+
+    Args:
+        llm_issues (list): Issues parsed from the LLM output.
+        filename (str): Name of the reviewed file.
+        patch (str): The diff patch content.
+        custom_guidelines (str, optional): User-provided project guidelines.
+        rag_context (str): RAG context included in the prompt ("" if none).
+
+    Returns:
+        list: The same issue dicts, enriched in place.
+    """
+    # Clean file: nothing to enrich, skip parsing the diff
+    if not llm_issues:
+        return llm_issues
+
+    # Enhance issues with code context if not already provided. Only the first
+    # section is used, so parsing stops as soon as it is complete.
+    first_section = next(iter_code_sections(iter_added_lines(patch)), None)
+    for issue in llm_issues:
+        # Ensure filename is set
+        if "filename" not in issue:
+            issue["filename"] = filename
+        # If LLM didn't provide code context, add it
+        if "code_snippet" not in issue or not issue["code_snippet"]:
+            if first_section:
+                issue["line_start"] = first_section["start_line"]
+                issue["line_end"] = first_section["end_line"]
+                issue["code_snippet"] = "\n".join(
+                    f"{line['code']}" for line in first_section["lines"]
+                )
+        # Ensure line numbers are present
+        if "line_start" not in issue and first_section:
+            issue["line_start"] = first_section["start_line"]
+        if "line_end" not in issue and first_section:
+            issue["line_end"] = first_section["end_line"]
+        # Tag issue source
+        if custom_guidelines:
+            issue["source"] = "user"
+        elif rag_context:
+            issue["source"] = "rag"
+        else:
+            issue["source"] = "global"
+        # Attach rule details if present in LLM output
+        # (Assume LLM output includes rule_id, title, description, fix if available)
+    return llm_issues
+
+
+async def _prepare_review(f: Dict[str, Any], custom_guidelines: Optional[str],
+                          project_name: Optional[str],
+                          rag_contexts: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """
+    Run static checks on a PR file and build its LLM prompt (if the language is supported).
+
+    Args:
+        f (dict): Parsed PR file with "filename" and "patch".
+        custom_guidelines (str, optional): User-provided project guidelines.
+        project_name (str, optional): "owner/repo" used to filter RAG guidelines.
+        rag_contexts (dict, optional): Prefetched RAG context per filename.
+
+    Returns:
+        dict: Review in progress with "filename", "patch", "issues", "messages"
+        (None when the LLM should be skipped), "rag_context", "cached",
+        "language" and "dedup_key" (identical for files whose prompts differ
+        only by name).
+    """
+    filename = f["filename"]
+    patch = f.get("patch", "")
+
+    # Detect language from file extension
+    language = get_file_language(filename)
+
+    review = {
+        "filename": filename,
+        "patch": patch,
+        "issues": [],
+        "messages": None,
+        "rag_context": "",
+        "cached": False,
+        "language": language,
+        "dedup_key": _dedup_key(language, patch),
+    }
+
+    patch_bytes = len(patch) if patch.isascii() else len(patch.encode("utf-8"))
+    if patch_bytes > MAX_PATCH_BYTES:
+        # Too large to scan or prompt usefully; report it instead of reviewing
+        review["issues"].append({
+            "type": "performance",
+            "message": f"Patch too large for review ({patch_bytes // 1024} KB).",
+            "suggestion": "Split this change into smaller pull requests or commits.",
+            "source": "global",
+            "rule_id": "PERF-002",
+            "rule_title": "Patch too large for review",
+            "rule_description": f"Patches over {MAX_PATCH_BYTES // 1024} KB are not reviewed automatically.",
+            "rule_fix": "Split the change into smaller pull requests or commits."
+        })
+        return review
+
+    # --- Static checks ---
+    review["issues"] = _static_findings(patch)
+
+    # --- LLM-based review for supported languages ---
+    if language == "Unknown":
+        return review
+
+    skip_reason = _llm_skip_reason(filename, patch, has_static_hits=bool(review["issues"]))
+    if skip_reason:
+        print(f"⏭️ Skipping LLM review for {filename}: {skip_reason}")
+    else:
+        # Prompt building may hit the vector store, keep it off the event loop
+        review["messages"], review["rag_context"] = await asyncio.to_thread(
+            _build_review_messages, filename, language, patch, custom_guidelines, project_name,
+            (rag_contexts or {}).get(filename)
+        )
+    return review
+
+
+def _apply_llm_output(review: Dict[str, Any], llm_output: str, custom_guidelines: Optional[str]) -> None:
+    """
+    Parse raw LLM output and append the resulting issues to a review.
+
+    Args:
+        review (dict): Review returned by _prepare_review().
+        llm_output (str): Raw text returned by the LLM.
+        custom_guidelines (str, optional): User-provided project guidelines.
+    """
+    llm_issues = safe_parse_json(llm_output, review["filename"])
+    if isinstance(llm_issues, list):
+        # The output may be shared with another file that has the same patch
+        for issue in llm_issues:
+            if isinstance(issue, dict):
+                issue["filename"] = review["filename"]
+        review["issues"].extend(
+            _enrich_llm_issues(llm_issues, review["filename"], review["patch"],
+                               custom_guidelines, review["rag_context"])
+        )
+
+
+def _apply_cached_output(review: Dict[str, Any], cache: LLMCache, custom_guidelines: Optional[str]) -> bool:
+    """
+    Apply a cached LLM response to a review, if one exists for its exact prompt.
+
+    Args:
+        review (dict): Review returned by _prepare_review() with messages set.
+        cache (LLMCache): Persistent response cache.
+        custom_guidelines (str, optional): User-provided project guidelines.
+
+    Returns:
+        bool: True on a cache hit. On a miss, review["cache_key"] is kept for storing the response.
+    """
+    review["cache_key"] = LLMCache.make_key(client.model, [m.content for m in review["messages"]])
+    cached_output = cache.get(review["cache_key"])
+    if cached_output is None:
+        return False
+    review["cached"] = True
+    _apply_llm_output(review, cached_output, custom_guidelines)
+    return True
+
+
+def _json_complete_detector(open_char: str = "[", close_char: str = "]"):
+    """
+    Build a stop_when callback for LLMClient.astream_invoke().
+
+    Args:
+        open_char (str): "[" when expecting a JSON array, "{" for an object.
+        close_char (str): The matching closing character.
+
+    Returns:
+        callable: Takes each streamed text piece and returns True once a
+        complete, valid top-level JSON value has arrived (only re-scans when
+        close_char shows up, so prose like "[note]" does not end the stream).
+    """
+    received: List[str] = []
+
+    def stop_when(piece: str) -> bool:
+        received.append(piece)
+        if close_char not in piece:
+            return False
+        for candidate in _iter_json_spans("".join(received), open_char, close_char):
+            try:
+                _json_loads(candidate)
+                return True
+            except json.JSONDecodeError:
+                continue
+        return False
+
+    return stop_when
+
+
+async def _invoke_llm(messages: List[BaseMessage], semaphore: asyncio.Semaphore,
+                      open_char: str = "[", close_char: str = "]") -> Any:
+    """Send one prompt to the LLM while holding a concurrency slot."""
+    async with semaphore:
+        if STREAM_REVIEWS:
+            return await client.astream_invoke(messages, stop_when=_json_complete_detector(open_char, close_char))
+        return await client.ainvoke(messages)
+
+
+async def _review_file(f: Dict[str, Any], custom_guidelines: Optional[str],
+                       project_name: Optional[str],
+                       semaphore: asyncio.Semaphore,
+                       cache: Optional[LLMCache],
+                       inflight: Dict[bytes, asyncio.Future],
+                       rag_contexts: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """
+    Review a single PR file: static checks plus LLM review for supported languages.
+
+    Args:
+        f (dict): Parsed PR file with "filename" and "patch".
+        custom_guidelines (str, optional): User-provided project guidelines.
+        project_name (str, optional): "owner/repo" used to filter RAG guidelines.
+        semaphore (asyncio.Semaphore): Bounds concurrent LLM requests.
+        cache (LLMCache, optional): Persistent response cache, None to bypass.
+        inflight (dict): LLM calls already started in this PR, by dedup key;
+            files with an identical patch await the same call.
+        rag_contexts (dict, optional): Prefetched RAG context per filename.
+
+    Returns:
+        dict: Completed review (see _prepare_review()).
+    """
+    review = await _prepare_review(f, custom_guidelines, project_name, rag_contexts)
+
+    if review["messages"]:
+        if cache and _apply_cached_output(review, cache, custom_guidelines):
+            return review
+        try:
+            call = inflight.get(review["dedup_key"])
+            if call is None:
+                call = inflight[review["dedup_key"]] = asyncio.ensure_future(
+                    _invoke_llm(review["messages"], semaphore)
+                )
+            else:
+                review["shared"] = True
+            response = await call
+            _apply_llm_output(review, response.content, custom_guidelines)
+            if cache:
+                cache.set(review["cache_key"], response.content)
+        except Exception as e:
+            print(f"❌ LLM review failed for {review['filename']}: {e}")
+    return review
+
+
+def _split_pending(reviews: List[Any], cache: Optional[LLMCache],
+                   custom_guidelines: Optional[str]) -> Tuple[List[Dict[str, Any]], Dict[bytes, Dict[str, Any]]]:
+    """
+    Apply cache hits and pick one review per distinct prompt for the rest.
+
+    Args:
+        reviews (list): Results of _prepare_review() (or Exceptions).
+        cache (LLMCache, optional): Persistent response cache, None to bypass.
+        custom_guidelines (str, optional): User-provided project guidelines.
+
+    Returns:
+        tuple: (pending, unique) where pending holds every review still needing
+        an LLM response and unique maps each dedup key to the review whose
+        prompt is sent; the others are marked "shared".
+    """
+    pending = [
+        r for r in reviews
+        if not isinstance(r, Exception) and r["messages"]
+        and not (cache and _apply_cached_output(r, cache, custom_guidelines))
+    ]
+    unique: Dict[bytes, Dict[str, Any]] = {}
+    for review in pending:
+        if review["dedup_key"] in unique:
+            review["shared"] = True
+        else:
+            unique[review["dedup_key"]] = review
+    return pending, unique
+
+
+def _apply_shared_outputs(pending: List[Dict[str, Any]], outputs: Dict[bytes, Any],
+                          cache: Optional[LLMCache], custom_guidelines: Optional[str]) -> None:
+    """
+    Fan LLM outputs (raw text or Exception, by dedup key) out to every pending review.
+
+    Args:
+        pending (list): Reviews returned by _split_pending().
+        outputs (dict): LLM output per dedup key; missing keys are skipped.
+        cache (LLMCache, optional): Persistent response cache, None to bypass.
+        custom_guidelines (str, optional): User-provided project guidelines.
+    """
+    for review in pending:
+        output = outputs.get(review["dedup_key"])
+        if output is None:
+            continue
+        if isinstance(output, Exception):
+            print(f"❌ LLM review failed for {review['filename']}: {output}")
+            continue
+        _apply_llm_output(review, output, custom_guidelines)
+        if cache:
+            cache.set(review["cache_key"], output)
+
+
+async def _review_files_batched(files: List[Dict[str, Any]], custom_guidelines: Optional[str],
+                                project_name: Optional[str],
+                                cache: Optional[LLMCache],
+                                rag_contexts: Optional[Dict[str, str]] = None) -> List[Any]:
+    """
+    Review PR files with a single provider batch request for all LLM prompts.
+
+    Args:
+        files (list): Parsed PR files with non-empty patches.
+        custom_guidelines (str, optional): User-provided project guidelines.
+        project_name (str, optional): "owner/repo" used to filter RAG guidelines.
+        cache (LLMCache, optional): Persistent response cache, None to bypass.
+        rag_contexts (dict, optional): Prefetched RAG context per filename.
+
+    Returns:
+        list: One completed review (or Exception) per file, in order.
+    """
+    reviews = await asyncio.gather(
+        *(_prepare_review(f, custom_guidelines, project_name, rag_contexts) for f in files),
+        return_exceptions=True
+    )
+    # Send each distinct patch once and fan the response out to its duplicates
+    pending, unique = _split_pending(reviews, cache, custom_guidelines)
+    if not unique:
+        return reviews
+
+    try:
+        responses = await client.abatch([r["messages"] for r in unique.values()])
+    except Exception as e:
+        print(f"❌ Batch LLM review failed: {e}")
+        return reviews
+
+    outputs = {
+        key: response if isinstance(response, Exception) else response.content
+        for key, response in zip(unique, responses)
+    }
+    _apply_shared_outputs(pending, outputs, cache, custom_guidelines)
+    return reviews
+
+
+def _group_reviews(reviews: Iterable[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """
+    Pack reviews of the same language into groups for combined LLM calls.
+
+    A group holds at most FILES_PER_LLM_CALL files and MAX_GROUP_PATCH_CHARS
+    characters of patch (a single larger file still gets its own group).
+
+    Args:
+        reviews (iterable): Prepared reviews needing an LLM response.
+
+    Returns:
+        list: Groups of reviews sharing one system prompt.
+    """
+    by_language: Dict[str, List[Dict[str, Any]]] = {}
+    for review in reviews:
+        by_language.setdefault(review["language"], []).append(review)
+
+    groups = []
+    for same_language in by_language.values():
+        group, size = [], 0
+        for review in same_language:
+            if group and (len(group) >= FILES_PER_LLM_CALL or size + len(review["patch"]) > MAX_GROUP_PATCH_CHARS):
+                groups.append(group)
+                group, size = [], 0
+            group.append(review)
+            size += len(review["patch"])
+        if group:
+            groups.append(group)
+    return groups
+
+
+async def _run_review_group(group: List[Dict[str, Any]], semaphore: asyncio.Semaphore,
+                            outputs: Dict[bytes, Any]) -> None:
+    """
+    Get LLM output for a group of reviews, one call for the whole group when possible.
+
+    Files the grouped answer leaves out (or a failed grouped call) fall back to
+    one call per file.
+
+    Args:
+        group (list): Reviews from _group_reviews().
+        semaphore (asyncio.Semaphore): Bounds concurrent LLM requests.
+        outputs (dict): Filled with raw LLM output (or Exception) per dedup key.
+    """
+    if len(group) > 1:
+        try:
+            response = await _invoke_llm(_build_group_messages(group), semaphore, "{", "}")
+            answered = _parse_grouped_output(response.content, [r["filename"] for r in group])
+        except Exception as e:
+            print(f"⚠️ Grouped LLM review failed, retrying files one by one: {e}")
+            answered = {}
+        for review in group:
+            if review["filename"] in answered:
+                # Stored in the same shape as a per-file answer, so the cache entry is reusable
+                outputs[review["dedup_key"]] = json.dumps(answered[review["filename"]])
+        group = [r for r in group if r["filename"] not in answered]
+
+    async def review_alone(review: Dict[str, Any]) -> None:
+        try:
+            outputs[review["dedup_key"]] = (await _invoke_llm(review["messages"], semaphore)).content
+        except Exception as e:
+            outputs[review["dedup_key"]] = e
+
+    await asyncio.gather(*(review_alone(r) for r in group))
+
+
+async def _review_files_grouped(files: List[Dict[str, Any]], custom_guidelines: Optional[str],
+                                project_name: Optional[str],
+                                cache: Optional[LLMCache],
+                                rag_contexts: Optional[Dict[str, str]] = None) -> List[Any]:
+    """
+    Review PR files with several same-language files per LLM call.
+
+    Args:
+        files (list): Parsed PR files with non-empty patches.
+        custom_guidelines (str, optional): User-provided project guidelines.
+        project_name (str, optional): "owner/repo" used to filter RAG guidelines.
+        cache (LLMCache, optional): Persistent response cache, None to bypass.
+        rag_contexts (dict, optional): Prefetched RAG context per filename.
+
+    Returns:
+        list: One completed review (or Exception) per file, in order.
+    """
+    reviews = await asyncio.gather(
+        *(_prepare_review(f, custom_guidelines, project_name, rag_contexts) for f in files),
+        return_exceptions=True
+    )
+    pending, unique = _split_pending(reviews, cache, custom_guidelines)
+
+    semaphore = asyncio.Semaphore(MAX_REVIEW_CONCURRENCY)
+    outputs: Dict[bytes, Any] = {}
+    await asyncio.gather(*(_run_review_group(g, semaphore, outputs) for g in _group_reviews(unique.values())))
+
+    _apply_shared_outputs(pending, outputs, cache, custom_guidelines)
+    return reviews
+
+
+async def code_review_agent(state: CodeReviewAgentState) -> Dict[str, Any]:
     """
     Perform static checks and LLM-based code review on PR files.
 
+    Files are reviewed concurrently; at most MAX_REVIEW_CONCURRENCY LLM
+    requests are in flight at once, and each file's findings are emitted as a
+    {"file_findings": ...} custom stream event as soon as it completes. When
+    state.use_batch_api is set, all prompts are sent as one provider batch
+    request instead; when FILES_PER_LLM_CALL > 1, same-language files are
+    reviewed several per call. Files with identical patches share one LLM
+    call. Responses are cached on disk by prompt hash unless
+    state.cache_enabled is False.
+
     Args:
         state (CodeReviewAgentState): Current agent state with PR files.
 
     Returns:
-        CodeReviewAgentState: Updated state with 'findings' populated.
+        dict: State update with 'findings' populated. Only the changed key is
+        returned because this node runs in parallel with test_coverage.
     """
-    findings = []
+    # Get custom guidelines from state if provided
+    custom_guidelines = getattr(state, "guideline_text", None) or getattr(state, "custom_guidelines", None)
+    project_name = getattr(state, "project_name", None)
 
+    # Skip non-code files (images, binaries, etc.) and repeated entries of the same file
+    files = []
+    seen = set()
     for f in state.files:
-        filename = f["filename"]
         patch = f.get("patch", "")
-        file_findings = []
-
-        # Skip non-code files (images, binaries, etc.)
-        if not patch.strip():
+        key = (f["filename"], patch)
+        if key in seen or not patch.strip():
             continue
-            
-        # Detect language from file extension
-        language = get_file_language(filename)
-        
-        # --- Static checks ---
-        for keyword, issue in STATIC_ISSUES.items():
-            if keyword in patch:
-                # Attach rule details if available from global rules
-                rule_detail = None
-                for gr in GLOBAL_RULES:
-                    if keyword.lower() in gr.get("title", "").lower() or keyword.lower() in gr.get("description", "").lower():
-                        rule_detail = gr
-                        break
-                enriched_issue = {**issue, "source": "global"}
-                if rule_detail:
-                    enriched_issue.update({
-                        "rule_id": rule_detail.get("id"),
-                        "rule_title": rule_detail.get("title"),
-                        "rule_description": rule_detail.get("description"),
-                        "rule_fix": rule_detail.get("fix")
-                    })
-                file_findings.append(enriched_issue)
-
-        # Detect large files/functions
-        if len(patch.splitlines()) > 200:
-            file_findings.append({
-                "type": "performance",
-                "message": "Large file/function detected (>200 lines).",
-                "suggestion": "Split into smaller, modular functions.",
-                "source": "global",
-                "rule_id": "PERF-001",
-                "rule_title": "Large file/function",
-                "rule_description": "Files or functions should not exceed 200 lines for maintainability.",
-                "rule_fix": "Refactor into smaller, modular functions."
-            })
+        seen.add(key)
+        files.append(f)
 
-        # --- LLM-based review for supported languages ---
-        if language != "Unknown" and patch.strip():
-            # Get language-specific best practices
-            best_practices = LANGUAGE_BEST_PRACTICES.get(language, [])
-            best_practices_text = "\n".join(f"- {bp}" for bp in best_practices) if best_practices else "Follow general coding standards."
-
-            # Get custom guidelines from state if provided
-            custom_guidelines = getattr(state, "guideline_text", None) or getattr(state, "custom_guidelines", None)
-            custom_guidelines_section = f"\n\n**Custom Project Guidelines:**\n{custom_guidelines}" if custom_guidelines else "\nNo custom guidelines provided."
-
-            # Format global rules and extended rules
-            global_rules_text = _format_global_rules_for_prompt(GLOBAL_RULES)
-            extended_rules_text = f"\n\n**Extended Best Practices:**\n{EXTENDED_RULES}" if EXTENDED_RULES else ""
-
-            # 🆕 RAG: Retrieve relevant context from vector database
-            rag_context = ""
-            if RAG_ENABLED:
-                try:
-                    retriever = get_rag_retriever()
-                    project_name = getattr(state, "project_name", None)
-                    
-                    # Get relevant context based on the code patch
-                    context = retriever.get_relevant_context(
-                        code_snippet=patch[:500],  # Use first 500 chars for search
-                        language=language,
-                        project_name=project_name,
-                        max_rules=5,
-                        max_guidelines=3
-                    )
-                    
-                    # Format context for prompt
-                    rag_context = retriever.format_context_for_prompt(context)
-                    if rag_context:
-                        print(f"  🔍 RAG: Retrieved {len(context.get('rules', []))} rules + {len(context.get('guidelines', []))} guidelines")
-                except Exception as e:
-                    print(f"  ⚠️ RAG retrieval failed: {e}")
-
-            # Build the complete prompt using the template
-            prompt = PROMPT_TEMPLATE.format(
-                filename=filename,
-                language=language,
-                best_practices_text=best_practices_text + extended_rules_text + global_rules_text + ("\n\n" + rag_context if rag_context else ""),
-                custom_guidelines_section=custom_guidelines_section,
-                patch=patch
-            )
+    cache = None
+    if getattr(state, "cache_enabled", True):
+        try:
+            cache = get_llm_cache()
+        except Exception as e:
+            print(f"⚠️ LLM cache unavailable, reviewing without it: {e}")
+
+    prompt_tokens_before, cached_tokens_before = client.usage_snapshot()
+
+    # One embedding request for every file instead of one per file
+    rag_contexts = await asyncio.to_thread(_prefetch_rag_contexts, files, project_name)
 
+    if getattr(state, "use_batch_api", False):
+        results = await _review_files_batched(files, custom_guidelines, project_name, cache, rag_contexts)
+    elif FILES_PER_LLM_CALL > 1:
+        results = await _review_files_grouped(files, custom_guidelines, project_name, cache, rag_contexts)
+    else:
+        semaphore = asyncio.Semaphore(MAX_REVIEW_CONCURRENCY)
+        inflight: Dict[bytes, asyncio.Future] = {}
+        tasks = [
+            asyncio.ensure_future(
+                _review_file(f, custom_guidelines, project_name, semaphore, cache, inflight, rag_contexts)
+            )
+            for f in files
+        ]
+        # Publish each file's findings as soon as it is reviewed
+        write_progress = progress_writer()
+        for next_done in asyncio.as_completed(tasks):
             try:
-                response = client.invoke([HumanMessage(content=prompt)])
-                llm_output = response.content
-                llm_issues = safe_parse_json(llm_output, filename)
-                if isinstance(llm_issues, list):
-                    # Enhance issues with code context if not already provided
-                    code_blocks = extract_code_context(patch)
-                    sections = group_code_by_context(code_blocks)
-                    for issue in llm_issues:
-                        # Ensure filename is set
-                        if "filename" not in issue:
-                            issue["filename"] = filename
-                        # If LLM didn't provide code context, add it
-                        if "code_snippet" not in issue or not issue["code_snippet"]:
-                            if sections:
-                                first_section = sections[0]
-                                issue["line_start"] = first_section["start_line"]
-                                issue["line_end"] = first_section["end_line"]
-                                issue["code_snippet"] = "\n".join(
-                                    f"{line['code']}" for line in first_section["lines"]
-                                )
-                        # Ensure line numbers are present
-                        if "line_start" not in issue and sections:
-                            issue["line_start"] = sections[0]["start_line"]
-                        if "line_end" not in issue and sections:
-                            issue["line_end"] = sections[0]["end_line"]
-                        # Tag issue source
-                        if custom_guidelines:
-                            issue["source"] = "user"
-                        elif rag_context:
-                            issue["source"] = "rag"
-                        else:
-                            issue["source"] = "global"
-                        # Attach rule details if present in LLM output
-                        # (Assume LLM output includes rule_id, title, description, fix if available)
-                    file_findings.extend(llm_issues)
-            except Exception as e:
-                print(f"❌ LLM review failed for {filename}: {e}")
+                review = await next_done
+            except Exception:
+                continue  # reported below
+            write_progress({"file_findings": {"filename": review["filename"], "issues": review["issues"]}})
+        results = await asyncio.gather(*tasks, return_exceptions=True)
 
-        if file_findings:
+    findings = []
+    cache_hits = cache_misses = shared_calls = 0
+    for f, result in zip(files, results):
+        if isinstance(result, Exception):
+            print(f"❌ Review failed for {f['filename']}: {result}")
+            continue
+        if result.get("shared"):
+            shared_calls += 1
+        if result["messages"]:
+            if result["cached"]:
+                cache_hits += 1
+            else:
+                cache_misses += 1
+        if result["issues"]:
             findings.append({
-                "filename": filename,
-                "issues": file_findings
+                "filename": result["filename"],
+                "issues": result["issues"]
             })
 
-    state.findings = findings
-    return state
\ No newline at end of file
+    if shared_calls:
+        print(f"  🔁 {shared_calls} file(s) with duplicate patches reused another file's LLM review")
+    prompt_tokens, cached_tokens = client.usage_snapshot()
+    prompt_tokens -= prompt_tokens_before
+    cached_tokens -= cached_tokens_before
+    if prompt_tokens:
+        print(f"  🧠 Provider prompt cache: {cached_tokens}/{prompt_tokens} prompt tokens "
+              f"({cached_tokens / prompt_tokens:.0%}) served from cache")
+    if cache:
+        print(f"  💾 LLM cache: {cache_hits} hit(s), {cache_misses} miss(es)")
+
+    return {"findings": findings}
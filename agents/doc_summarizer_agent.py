@@ -1,6 +1,9 @@
 import os
+import re
+from collections import Counter
 from dotenv import load_dotenv
 from agents.llm_client import get_llm_client
+from agents.progress import progress_writer
 from agents.prompt_loader import load_prompt
 from langchain_core.messages import HumanMessage
 from agents.state import TestCoverageAgentState
@@ -17,6 +20,9 @@ llm = get_llm_client()
 # --------------------------
 PROMPT_TEMPLATE = load_prompt("doc_summarizer_prompt.txt")
 
+# Added diff line that defines a function or class
+_NEW_ENTITY_RE = re.compile(r"^\+.*(?:def |class )", re.MULTILINE)
+
 
 def doc_summarizer_agent(state: TestCoverageAgentState) -> TestCoverageAgentState:
     """
@@ -32,15 +38,13 @@ def doc_summarizer_agent(state: TestCoverageAgentState) -> TestCoverageAgentStat
         TestCoverageAgentState: Updated state with `pr_summary` populated.
     """
     # --- Count file changes ---
-    added = sum(1 for f in state.files if f.get("status") == "added")
-    removed = sum(1 for f in state.files if f.get("status") == "removed")
-    modified = sum(1 for f in state.files if f.get("status") not in ("added", "removed"))
+    statuses = Counter(f.get("status") for f in state.files)
+    added = statuses["added"]
+    removed = statuses["removed"]
+    modified = len(state.files) - added - removed
 
-    # --- Count new functions/classes ---
-    new_entities = 0
-    for f in state.files:
-        patch = f.get("patch", "")
-        new_entities += sum(1 for line in patch.splitlines() if line.startswith("+") and ("def " in line or "class " in line))
+    # --- Count new functions/classes (one regex scan per patch) ---
+    new_entities = sum(len(_NEW_ENTITY_RE.findall(f.get("patch", ""))) for f in state.files)
 
     # --- Count generated tests ---
     gen_tests = 0
@@ -56,8 +60,13 @@ def doc_summarizer_agent(state: TestCoverageAgentState) -> TestCoverageAgentStat
         new_entities=new_entities,
         gen_tests=gen_tests
     )
+    # Publish the summary piece by piece while it is generated
+    write_progress = progress_writer()
     try:
-        response = llm.invoke([HumanMessage(content=prompt)])
+        response = llm.stream_invoke(
+            [HumanMessage(content=prompt)],
+            on_piece=lambda piece: write_progress({"summary_delta": piece})
+        )
         summary = response.content.strip()
     except Exception as e:
         print(f"⚠️ Doc summarizer LLM failed: {e}")
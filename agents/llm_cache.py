@@ -0,0 +1,88 @@
+"""
+Persistent cache for LLM responses.
+
+Responses are keyed by a SHA-256 of the model name and the full prompt, so any
+change to the patch, rules, guidelines or RAG context produces a new key and
+re-runs of an unchanged PR skip the LLM call entirely.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+CACHE_PATH = Path(os.getenv("LLM_CACHE_PATH", "~/.pullpal/cache/llm_cache.sqlite3")).expanduser()
+CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(30 * 24 * 3600)))  # seconds (30 days)
+
+
+class LLMCache:
+    """SQLite-backed key/value store for raw LLM response text."""
+
+    def __init__(self, path: Path = CACHE_PATH, ttl: int = CACHE_TTL):
+        """Open (or create) the cache database.
+
+        Args:
+            path: Location of the SQLite database file
+            ttl: Entries older than this many seconds are treated as misses
+        """
+        self.path = Path(path)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_responses ("
+            "key TEXT PRIMARY KEY, content TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model: str, contents: List[str]) -> str:
+        """Build a cache key from the model name and prompt message contents.
+
+        Args:
+            model: LLM model name
+            contents: Text content of every message sent to the LLM
+
+        Returns:
+            Hex SHA-256 digest
+        """
+        digest = hashlib.sha256(model.encode("utf-8"))
+        for content in contents:
+            digest.update(b"\x00")
+            digest.update(content.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response text, or None if missing or expired."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content, created_at FROM llm_responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row and time.time() - row[1] <= self.ttl:
+            return row[0]
+        return None
+
+    def set(self, key: str, content: str):
+        """Store response text under the given key."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_responses (key, content, created_at) VALUES (?, ?, ?)",
+                (key, content, time.time())
+            )
+            self._conn.commit()
+
+
+# Singleton instance
+_llm_cache = None
+
+def get_llm_cache() -> LLMCache:
+    """Get or create singleton LLM cache instance."""
+    global _llm_cache
+    if _llm_cache is None:
+        _llm_cache = LLMCache()
+    return _llm_cache
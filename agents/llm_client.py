@@ -3,26 +3,75 @@
 When HOST_URL is set, uses OpenAI SDK with custom base_url.
 Otherwise, fall back to langchain_google_genai.ChatGoogleGenerativeAI.
 """
+import asyncio
+import json
 import os
-from typing import List, Any
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+# Seconds between status polls while waiting for an OpenAI batch job
+BATCH_POLL_INTERVAL = float(os.getenv("LLM_BATCH_POLL_INTERVAL", "10"))
+# Longest wait (seconds) for an OpenAI batch job before it is cancelled
+BATCH_MAX_WAIT = float(os.getenv("LLM_BATCH_MAX_WAIT", "3600"))
+
+# Worker threads for blocking OpenAI SDK calls made from async code. The GIL is
+# released while waiting on the network, so calls overlap like real async I/O.
+LLM_MAX_WORKERS = int(os.getenv("LLM_MAX_WORKERS", "8"))
+_executor = ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS, thread_name_prefix="llm")
+
+# Connection pool for the OpenAI-compatible endpoint, shared by all worker threads.
+# HTTP/2 multiplexes concurrent reviews over one connection when h2 is installed.
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "64"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "600"))
+try:
+    import h2  # noqa: F401  (enables httpx HTTP/2 support)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Chunks still read after stop_when ends a stream early, waiting for the final
+# usage chunk (prompt/cached token counts) before the connection is closed
+STREAM_USAGE_DRAIN_CHUNKS = int(os.getenv("LLM_STREAM_USAGE_DRAIN_CHUNKS", "8"))
+
+# Mark system prompts with Anthropic-style cache_control blocks (for proxies that
+# forward them). OpenAI-native endpoints cache identical prefixes automatically.
+CACHE_CONTROL_ENABLED = os.getenv("LLM_CACHE_CONTROL", "0") == "1"
 
 
 class LLMClient:
     """Unified LLM client supporting custom HOST_URL or langchain backends."""
     
-    def __init__(self, api_key: str, model: str, temperature: float = 0.0, host_url: str = None):
+    def __init__(self, api_key: str, model: str, temperature: float = 0.0, host_url: str = None,
+                 convert_system_message_to_human: bool = False):
         self.api_key = api_key
         self.model = model
         self.temperature = temperature
         self.host_url = host_url
         
+        # Running totals of prompt tokens and how many were served from the
+        # provider's prompt cache (updated from worker threads)
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self._usage_lock = threading.Lock()
+        
         # If custom host, use OpenAI SDK with base_url
         if self.host_url:
             try:
+                import httpx
                 import openai
                 self._openai_client = openai.OpenAI(
                     base_url=host_url,
-                    api_key=api_key
+                    api_key=api_key,
+                    http_client=httpx.Client(
+                        http2=HTTP2_AVAILABLE,
+                        limits=httpx.Limits(
+                            max_connections=LLM_MAX_CONNECTIONS,
+                            max_keepalive_connections=LLM_MAX_CONNECTIONS // 2
+                        ),
+                        timeout=httpx.Timeout(LLM_TIMEOUT, connect=5.0)
+                    )
                 )
                 self._langchain_client = None
             except ImportError as e:
@@ -36,7 +85,8 @@ class LLMClient:
                 self._langchain_client = ChatGoogleGenerativeAI(
                     api_key=api_key,
                     model=model,
-                    temperature=temperature
+                    temperature=temperature,
+                    convert_system_message_to_human=convert_system_message_to_human
                 )
                 self._openai_client = None
             except Exception as e:
@@ -47,46 +97,283 @@ class LLMClient:
     
     def invoke(self, messages: List[Any]) -> Any:
         """Invoke LLM with messages and return response object with .content attribute."""
+        # Route to OpenAI client or langchain
+        if self._openai_client:
+            return self._invoke_openai(_to_openai_messages(messages))
+        else:
+            response = self._langchain_client.invoke(messages)
+            self._record_usage(response)
+            return response
+    
+    async def ainvoke(self, messages: List[Any]) -> Any:
+        """Async variant of invoke() so several files can be reviewed concurrently.
         
-        # Extract message content (handle both HumanMessage objects and strings)
-        message_contents = []
-        for msg in messages:
-            if hasattr(msg, 'content'):
-                message_contents.append(msg.content)
-            else:
-                message_contents.append(str(msg))
+        The OpenAI path runs the sync SDK on a shared thread pool: its connection
+        pool is not tied to an event loop, so it stays reusable across the separate
+        asyncio.run() calls made per review.
+        """
+        if self._openai_client:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(_executor, self._invoke_openai, _to_openai_messages(messages))
+        else:
+            response = await self._langchain_client.ainvoke(messages)
+            self._record_usage(response)
+            return response
+    
+    def usage_snapshot(self) -> tuple:
+        """Return (prompt_tokens, cached_prompt_tokens) counted so far."""
+        with self._usage_lock:
+            return self.prompt_tokens, self.cached_prompt_tokens
+    
+    def _record_usage(self, response: Any) -> None:
+        """Add a response's prompt token usage (OpenAI or langchain format) to the totals."""
+        self._add_usage(*_usage_counts(response))
+    
+    def _add_usage(self, prompt_tokens: int, cached_tokens: int) -> None:
+        """Add prompt token counts to the running totals."""
+        if prompt_tokens:
+            with self._usage_lock:
+                self.prompt_tokens += prompt_tokens
+                self.cached_prompt_tokens += cached_tokens
+    
+    def stream_invoke(self, messages: List[Any], stop_when: Optional[Callable[[str], bool]] = None,
+                      on_piece: Optional[Callable[[str], None]] = None) -> Any:
+        """Invoke LLM with a streamed response and return it once complete.
         
-        # Route to OpenAI client or langchain
+        Prompt token usage is recorded from the stream's usage chunks. After an
+        early stop, up to STREAM_USAGE_DRAIN_CHUNKS more chunks are read for the
+        final usage chunk; if the model is still writing by then, the stream is
+        closed and that call's usage is not counted.
+        
+        Args:
+            messages: Messages to send, as for invoke().
+            stop_when: Called with each new piece of text; once it returns True the
+                stream is closed early (e.g. the JSON answer is complete), saving
+                the time and tokens of anything generated after it.
+            on_piece: Called with each new piece of text as it arrives (e.g. to
+                show the answer while it is being written).
+        
+        Returns:
+            Response object with .content holding the text received.
+        """
         if self._openai_client:
-            return self._invoke_openai(message_contents)
+            try:
+                stream = self._openai_client.chat.completions.create(
+                    model=self.model,
+                    messages=_to_openai_messages(messages),
+                    temperature=self.temperature,
+                    stream=True,
+                    stream_options={"include_usage": True}
+                )
+                with stream:
+                    collector = _StreamCollector(stop_when, on_piece)
+                    for chunk in stream:
+                        piece = chunk.choices[0].delta.content if chunk.choices else None
+                        if collector.add(chunk, piece):
+                            break
+            except Exception as e:
+                raise RuntimeError(f"OpenAI client request failed: {e}")
         else:
-            return self._langchain_client.invoke(messages)
+            collector = _StreamCollector(stop_when, on_piece)
+            stream = self._langchain_client.stream(messages)
+            try:
+                for chunk in stream:
+                    if collector.add(chunk, chunk.content):
+                        break
+            finally:
+                stream.close()
+        self._add_usage(collector.prompt_tokens, collector.cached_tokens)
+        return _Response("".join(collector.parts))
     
-    def _invoke_openai(self, message_contents: List[str]) -> Any:
-        """Use OpenAI SDK to call custom endpoint."""
-        # Convert to OpenAI message format
-        openai_messages = [{"role": "user", "content": content} for content in message_contents]
+    async def astream_invoke(self, messages: List[Any], stop_when: Optional[Callable[[str], bool]] = None,
+                             on_piece: Optional[Callable[[str], None]] = None) -> Any:
+        """Async variant of stream_invoke()."""
+        if self._openai_client:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(_executor, self.stream_invoke, messages, stop_when, on_piece)
+        collector = _StreamCollector(stop_when, on_piece)
+        stream = self._langchain_client.astream(messages)
+        try:
+            async for chunk in stream:
+                if collector.add(chunk, chunk.content):
+                    break
+        finally:
+            await stream.aclose()
+        self._add_usage(collector.prompt_tokens, collector.cached_tokens)
+        return _Response("".join(collector.parts))
+    
+    def batch(self, messages_list: List[List[Any]]) -> List[Any]:
+        """Invoke LLM for several prompts in a single provider batch request.
+        
+        Args:
+            messages_list: One list of messages per prompt.
         
+        Returns:
+            One response object (or Exception for failed items) per prompt, in order.
+        """
+        if self._openai_client:
+            return self._batch_openai([_to_openai_messages(messages) for messages in messages_list])
+        else:
+            return self._langchain_client.batch(messages_list, return_exceptions=True)
+    
+    async def abatch(self, messages_list: List[List[Any]]) -> List[Any]:
+        """Async variant of batch()."""
+        if self._openai_client:
+            # Polling a batch job can take long: keep it off the shared LLM pool
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.batch, messages_list)
+        else:
+            return await self._langchain_client.abatch(messages_list, return_exceptions=True)
+    
+    def _invoke_openai(self, openai_messages: List[dict]) -> Any:
+        """Use OpenAI SDK to call custom endpoint."""
         try:
             response = self._openai_client.chat.completions.create(
                 model=self.model,
                 messages=openai_messages,
                 temperature=self.temperature
             )
-            
-            # Extract content from OpenAI response
-            content = response.choices[0].message.content
-            
-            # Return object mimicking langchain response
-            class Response:
-                pass
-            
-            resp = Response()
-            resp.content = content
-            return resp
-            
+            self._record_usage(response)
+            return _Response(response.choices[0].message.content)
         except Exception as e:
             raise RuntimeError(f"OpenAI client request failed: {e}")
+    
+    def _batch_openai(self, openai_messages_list: List[List[dict]]) -> List[Any]:
+        """Submit prompts through the OpenAI Batch API and wait for the results.
+        
+        Jobs still running after BATCH_MAX_WAIT seconds are cancelled.
+        """
+        request_lines = [
+            json.dumps({
+                "custom_id": str(idx),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model,
+                    "messages": openai_messages,
+                    "temperature": self.temperature,
+                },
+            })
+            for idx, openai_messages in enumerate(openai_messages_list)
+        ]
+        
+        try:
+            batch_file = self._openai_client.files.create(
+                file=("batch.jsonl", "\n".join(request_lines).encode("utf-8")),
+                purpose="batch"
+            )
+            job = self._openai_client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+            deadline = time.monotonic() + BATCH_MAX_WAIT
+            while job.status not in ("completed", "failed", "expired", "cancelled"):
+                if time.monotonic() >= deadline:
+                    self._openai_client.batches.cancel(job.id)
+                    raise TimeoutError(f"batch {job.id} still '{job.status}' after {BATCH_MAX_WAIT:.0f}s, cancelled")
+                time.sleep(BATCH_POLL_INTERVAL)
+                job = self._openai_client.batches.retrieve(job.id)
+        except Exception as e:
+            raise RuntimeError(f"OpenAI batch request failed: {e}")
+        
+        if job.status != "completed" or not job.output_file_id:
+            raise RuntimeError(f"OpenAI batch {job.id} ended with status '{job.status}'")
+        
+        # Results come back in arbitrary order, map them back by custom_id
+        results: List[Any] = [RuntimeError("Missing result in OpenAI batch output")] * len(openai_messages_list)
+        output = self._openai_client.files.content(job.output_file_id).text
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response") or {}
+            if response.get("status_code") == 200:
+                usage = response["body"].get("usage") or {}
+                self._add_usage(
+                    usage.get("prompt_tokens", 0) or 0,
+                    (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0
+                )
+                content = response["body"]["choices"][0]["message"]["content"]
+                results[int(item["custom_id"])] = _Response(content)
+            else:
+                results[int(item["custom_id"])] = RuntimeError(
+                    f"OpenAI batch item failed: {item.get('error') or response}"
+                )
+        return results
+
+
+class _Response:
+    """Minimal object mimicking a langchain response (exposes .content)."""
+    
+    def __init__(self, content: str):
+        self.content = content
+
+
+class _StreamCollector:
+    """Accumulate the text and prompt token usage of a streamed response."""
+    
+    def __init__(self, stop_when: Optional[Callable[[str], bool]] = None,
+                 on_piece: Optional[Callable[[str], None]] = None):
+        self.stop_when = stop_when
+        self.on_piece = on_piece
+        self.parts: List[str] = []
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self._drain_left: Optional[int] = None  # set once stop_when fired
+    
+    def add(self, chunk: Any, piece: Any) -> bool:
+        """Record one stream chunk; return True when the stream should be closed."""
+        # OpenAI sends usage on a final chunk; langchain chunks carry usage deltas
+        prompt_tokens, cached_tokens = _usage_counts(chunk)
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens
+        
+        if self._drain_left is not None:
+            # Answer already complete: only wait (briefly) for the usage
+            self._drain_left -= 1
+            return self.prompt_tokens > 0 or self._drain_left <= 0
+        
+        if piece:
+            self.parts.append(piece)
+            if self.on_piece:
+                self.on_piece(piece)
+            if self.stop_when and self.stop_when(piece):
+                if self.prompt_tokens > 0 or STREAM_USAGE_DRAIN_CHUNKS <= 0:
+                    return True
+                self._drain_left = STREAM_USAGE_DRAIN_CHUNKS
+        return False
+
+
+def _usage_counts(response: Any) -> tuple:
+    """Return (prompt_tokens, cached_prompt_tokens) of a response or stream chunk."""
+    usage = getattr(response, "usage", None)
+    metadata = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        return getattr(usage, "prompt_tokens", 0) or 0, getattr(details, "cached_tokens", 0) or 0
+    if metadata:
+        return (
+            metadata.get("input_tokens", 0) or 0,
+            (metadata.get("input_token_details") or {}).get("cache_read", 0) or 0,
+        )
+    return 0, 0
+
+
+def _to_openai_messages(messages: List[Any]) -> List[dict]:
+    """Convert langchain messages (or plain strings) to OpenAI message format."""
+    openai_messages = []
+    for msg in messages:
+        if getattr(msg, "type", None) == "system":
+            content = msg.content
+            if CACHE_CONTROL_ENABLED:
+                content = [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]
+            openai_messages.append({"role": "system", "content": content})
+        elif hasattr(msg, 'content'):
+            openai_messages.append({"role": "user", "content": msg.content})
+        else:
+            openai_messages.append({"role": "user", "content": str(msg)})
+    return openai_messages
 
 
 def get_llm_client(convert_system_message_to_human: bool = False) -> LLMClient:
@@ -110,5 +397,6 @@ def get_llm_client(convert_system_message_to_human: bool = False) -> LLMClient:
         api_key=api_key,
         model=model,
         temperature=temperature,
-        host_url=host_url
+        host_url=host_url,
+        convert_system_message_to_human=convert_system_message_to_human
     )
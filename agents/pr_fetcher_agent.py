@@ -16,12 +16,12 @@ def pr_fetcher_agent(state: PRFetcherAgentState) -> PRFetcherAgentState:
     # Parse PR URL
     pr_info = parse_github_pr_url(state.pr_url)
 
-    # Fetch raw PR files using optional token
+    # Fetch raw PR files using optional token (the UI sets github_token)
     raw_files = fetch_pr_files(
         owner=pr_info["owner"],
         repo=pr_info["repo"],
         pr_number=pr_info["pr_number"],
-        token=state.token
+        token=state.token or state.github_token
     )
 
     # Parse files into normalized format
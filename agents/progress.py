@@ -0,0 +1,22 @@
+from typing import Any, Callable
+
+# Progress events for callers streaming the graph with stream_mode="custom"
+try:
+    from langgraph.config import get_stream_writer
+except ImportError:
+    get_stream_writer = None
+
+
+def progress_writer() -> Callable[[Any], None]:
+    """
+    Return LangGraph's custom stream writer, or a no-op when not streaming.
+
+    Returns:
+        Callable[[Any], None]: Function publishing one progress event.
+    """
+    if get_stream_writer is not None:
+        try:
+            return get_stream_writer()
+        except Exception:
+            pass
+    return lambda _: None
@@ -1,17 +1,21 @@
-import os
+from functools import lru_cache
+from pathlib import Path
 
+PROMPTS_DIR = Path(__file__).resolve().parent.parent / "prompts"
+
+
+@lru_cache(maxsize=None)
 def load_prompt(filename: str) -> str:
     """
     Load a prompt from the 'prompts' directory.
 
+    Results are cached per process, so agents sharing a prompt (or modules that
+    get re-imported) read each file from disk only once.
+
     Args:
         filename (str): The name of the prompt file.
 
     Returns:
         str: The content of the prompt file.
     """
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    prompts_dir = os.path.join(current_dir, '..', 'prompts')
-    prompt_path = os.path.join(prompts_dir, filename)
-    with open(prompt_path, 'r', encoding='utf-8') as f:
-        return f.read()
\ No newline at end of file
+    return (PROMPTS_DIR / filename).read_text(encoding="utf-8")
@@ -4,6 +4,7 @@ RAG Retriever for enhanced code review context.
 Retrieves relevant information from vector store to augment LLM prompts.
 """
 
+import threading
 from typing import List, Dict, Any, Optional
 from agents.vector_store import get_vector_store
 
@@ -31,27 +32,58 @@ class RAGRetriever:
         Returns:
             Dictionary with relevant rules and guidelines
         """
-        # Build search query combining code and language
-        query = f"{language} code review: {code_snippet}"
+        return self.get_relevant_context_batch(
+            [code_snippet], [language], project_name=project_name,
+            max_rules=max_rules, max_guidelines=max_guidelines
+        )[0]
+    
+    def get_relevant_context_batch(self, code_snippets: List[str], languages: List[str],
+                                   project_name: Optional[str] = None,
+                                   max_rules: int = 5,
+                                   max_guidelines: int = 3) -> List[Dict[str, Any]]:
+        """Get relevant context for several code snippets at once.
+        
+        All queries are embedded in one request, and the embeddings are shared
+        by the rules and guidelines searches.
+        
+        Args:
+            code_snippets: Code to review, one entry per file
+            languages: Programming language of each snippet
+            project_name: Project name for filtering guidelines
+            max_rules: Maximum number of rules to retrieve per snippet
+            max_guidelines: Maximum number of guideline chunks to retrieve per snippet
+            
+        Returns:
+            One context dictionary (see get_relevant_context()) per snippet, in order
+        """
+        # Build search queries combining code and language
+        queries = [f"{language} code review: {snippet}" for snippet, language in zip(code_snippets, languages)]
+        
+        # Embed every non-blank query once for both searches
+        embeddings = None
+        non_blank = [query for query in queries if query.strip()]
+        if non_blank:
+            embeddings = self.vector_store.generate_embeddings(non_blank)
         
         # Search for relevant rules
-        relevant_rules = self.vector_store.search_relevant_rules(
-            query=query,
-            n_results=max_rules
+        relevant_rules = self.vector_store.search_relevant_rules_batch(
+            queries=queries,
+            n_results=max_rules,
+            query_embeddings=embeddings
         )
         
         # Search for relevant project guidelines
-        relevant_guidelines = self.vector_store.search_project_guidelines(
-            query=query,
+        relevant_guidelines = self.vector_store.search_project_guidelines_batch(
+            queries=queries,
             project_name=project_name,
-            n_results=max_guidelines
+            n_results=max_guidelines,
+            query_embeddings=embeddings
         )
         
-        return {
-            "rules": relevant_rules,
-            "guidelines": relevant_guidelines,
-            "query": query
-        }
+        return [
+            {"rules": rules, "guidelines": guidelines, "query": query}
+            for query, rules, guidelines in zip(queries, relevant_rules, relevant_guidelines)
+        ]
     
     def format_context_for_prompt(self, context: Dict[str, Any]) -> str:
         """Format retrieved context into a string for LLM prompt.
@@ -100,12 +132,15 @@ class RAGRetriever:
         return self.vector_store.get_collection_stats()
 
 
-# Singleton instance
+# Singleton instance (prompts are built from worker threads, so creation is locked)
 _rag_retriever = None
+_rag_retriever_lock = threading.Lock()
 
 def get_rag_retriever() -> RAGRetriever:
     """Get or create singleton RAG retriever instance."""
     global _rag_retriever
     if _rag_retriever is None:
-        _rag_retriever = RAGRetriever()
+        with _rag_retriever_lock:
+            if _rag_retriever is None:
+                _rag_retriever = RAGRetriever()
     return _rag_retriever
@@ -2,7 +2,7 @@ from dataclasses import dataclass, field
 from typing import List, Dict, Any, Optional
 
 
-@dataclass
+@dataclass(slots=True)
 class PRFetcherAgentState:
     """
     State for the PR Fetcher Agent.
@@ -16,9 +16,11 @@ class PRFetcherAgentState:
     github_token: Optional[str] = None  # For private repo access
     # Optional project-specific coding guidelines provided by the user
     guideline_text: Optional[str] = None
+    # "owner/repo", used to filter RAG project guidelines
+    project_name: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class CodeReviewAgentState(PRFetcherAgentState):
     """
     State for the Code Review Agent.
@@ -26,9 +28,13 @@ class CodeReviewAgentState(PRFetcherAgentState):
     """
     findings: List[Dict[str, Any]] = field(default_factory=list)
     custom_guidelines: Optional[str] = None
+    # Send all LLM review prompts as one provider batch request (cheaper, but slower)
+    use_batch_api: bool = False
+    # Reuse cached LLM responses for unchanged prompts (see agents/llm_cache.py)
+    cache_enabled: bool = True
 
 
-@dataclass
+@dataclass(slots=True)
 class TestCoverageAgentState(CodeReviewAgentState):
     """
     State for the Test Coverage Agent.
@@ -37,7 +43,7 @@ class TestCoverageAgentState(CodeReviewAgentState):
     coverage_findings: List[Dict[str, Any]] = field(default_factory=list)
 
 
-@dataclass
+@dataclass(slots=True)
 class PRSummaryAgentState(TestCoverageAgentState):
     """
     State for the PR Summary Agent.
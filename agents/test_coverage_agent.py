@@ -1,5 +1,8 @@
+import asyncio
 import re
 import os
+from functools import lru_cache
+from typing import Any, Dict, List
 from dotenv import load_dotenv
 from agents.llm_client import get_llm_client
 from agents.prompt_loader import load_prompt
@@ -18,6 +21,9 @@ llm = get_llm_client(convert_system_message_to_human=True)
 # --------------------------
 PROMPT_TEMPLATE = load_prompt("test_coverage_prompt.txt")
 
+# Maximum number of in-flight test generation requests (shares the review limit)
+MAX_TEST_GEN_CONCURRENCY = int(os.getenv("REVIEW_CONCURRENCY", "8"))
+
 # --------------------------
 # Language and testing framework mapping
 # --------------------------
@@ -29,6 +35,7 @@ LANGUAGE_TEST_CONFIG = {
         "test_dir": "tests",
         "test_prefix": "test_",
         "function_patterns": [r"def\s+(\w+)", r"class\s+(\w+)"],
+        "keywords": ("def", "class"),
     },
     ".java": {
         "language": "Java",
@@ -37,6 +44,7 @@ LANGUAGE_TEST_CONFIG = {
         "test_dir": "src/test/java",
         "test_suffix": "Test",
         "function_patterns": [r"(public|private|protected)\s+\w+\s+(\w+)\s*\(", r"class\s+(\w+)"],
+        "keywords": ("public", "private", "protected", "class"),
     },
     ".js": {
         "language": "JavaScript",
@@ -45,6 +53,7 @@ LANGUAGE_TEST_CONFIG = {
         "test_dir": "__tests__",
         "test_suffix": ".test.js",
         "function_patterns": [r"function\s+(\w+)", r"const\s+(\w+)\s*=", r"class\s+(\w+)"],
+        "keywords": ("function", "const", "class"),
     },
     ".jsx": {
         "language": "JavaScript (React)",
@@ -53,6 +62,7 @@ LANGUAGE_TEST_CONFIG = {
         "test_dir": "__tests__",
         "test_suffix": ".test.jsx",
         "function_patterns": [r"function\s+(\w+)", r"const\s+(\w+)\s*=", r"class\s+(\w+)"],
+        "keywords": ("function", "const", "class"),
     },
     ".ts": {
         "language": "TypeScript",
@@ -61,6 +71,7 @@ LANGUAGE_TEST_CONFIG = {
         "test_dir": "__tests__",
         "test_suffix": ".test.ts",
         "function_patterns": [r"function\s+(\w+)", r"const\s+(\w+)\s*=", r"class\s+(\w+)"],
+        "keywords": ("function", "const", "class"),
     },
     ".tsx": {
         "language": "TypeScript (React)",
@@ -69,6 +80,7 @@ LANGUAGE_TEST_CONFIG = {
         "test_dir": "__tests__",
         "test_suffix": ".test.tsx",
         "function_patterns": [r"function\s+(\w+)", r"const\s+(\w+)\s*=", r"class\s+(\w+)"],
+        "keywords": ("function", "const", "class"),
     },
     ".go": {
         "language": "Go",
@@ -77,6 +89,7 @@ LANGUAGE_TEST_CONFIG = {
         "test_dir": "",
         "test_suffix": "_test.go",
         "function_patterns": [r"func\s+(\w+)", r"type\s+(\w+)\s+struct"],
+        "keywords": ("func", "struct"),
     },
     ".rs": {
         "language": "Rust",
@@ -85,6 +98,7 @@ LANGUAGE_TEST_CONFIG = {
         "test_dir": "tests",
         "test_suffix": "_test.rs",
         "function_patterns": [r"fn\s+(\w+)", r"struct\s+(\w+)"],
+        "keywords": ("fn", "struct"),
     },
     ".rb": {
         "language": "Ruby",
@@ -93,6 +107,7 @@ LANGUAGE_TEST_CONFIG = {
         "test_dir": "spec",
         "test_suffix": "_spec.rb",
         "function_patterns": [r"def\s+(\w+)", r"class\s+(\w+)"],
+        "keywords": ("def", "class"),
     },
     ".php": {
         "language": "PHP",
@@ -101,6 +116,7 @@ LANGUAGE_TEST_CONFIG = {
         "test_dir": "tests",
         "test_suffix": "Test.php",
         "function_patterns": [r"function\s+(\w+)", r"class\s+(\w+)"],
+        "keywords": ("function", "class"),
     },
     ".cs": {
         "language": "C#",
@@ -109,6 +125,7 @@ LANGUAGE_TEST_CONFIG = {
         "test_dir": "Tests",
         "test_suffix": "Tests.cs",
         "function_patterns": [r"(public|private|protected)\s+\w+\s+(\w+)\s*\(", r"class\s+(\w+)"],
+        "keywords": ("public", "private", "protected", "class"),
     },
     ".kt": {
         "language": "Kotlin",
@@ -117,14 +134,28 @@ LANGUAGE_TEST_CONFIG = {
         "test_dir": "src/test/kotlin",
         "test_suffix": "Test.kt",
         "function_patterns": [r"fun\s+(\w+)", r"class\s+(\w+)"],
+        "keywords": ("fun", "class"),
     },
 }
 
+# Compile each language's patterns once. The function patterns are joined into
+# one multiline regex matching whole added lines that contain a signature, so a
+# patch is scanned with a single finditer() (\s is kept from crossing lines).
+for _cfg in LANGUAGE_TEST_CONFIG.values():
+    _cfg["test_pattern_re"] = re.compile(_cfg["test_pattern"])
+    _alternation = "|".join(f"(?:{p})" for p in _cfg["function_patterns"]).replace(r"\s", r"[^\S\n]")
+    _cfg["added_signature_re"] = re.compile(rf"^\+(?=[^\n]*?(?:{_alternation}))(?P<line>[^\n]*)", re.MULTILINE)
+
+
+@lru_cache(maxsize=256)
+def _config_for_ext(ext: str):
+    """Map a lower-cased file extension to its language configuration (memoized)."""
+    return LANGUAGE_TEST_CONFIG.get(ext, None)
+
 
 def get_language_config(filename: str):
     """Get language configuration based on file extension."""
-    _, ext = os.path.splitext(filename.lower())
-    return LANGUAGE_TEST_CONFIG.get(ext, None)
+    return _config_for_ext(os.path.splitext(filename)[1].lower())
 
 
 def extract_added_functions(patch: str, config: dict) -> list[str]:
@@ -133,66 +164,83 @@ def extract_added_functions(patch: str, config: dict) -> list[str]:
 
     Args:
         patch (str): The diff string from a PR file.
-        config (dict): Language configuration with function_patterns.
+        config (dict): Language configuration with function_patterns and keywords.
 
     Returns:
         list[str]: List of added function/class signatures.
     """
-    added = []
     if not config:
-        return added
-        
-    patterns = config.get("function_patterns", [])
-    
-    for line in patch.splitlines():
-        if line.startswith("+"):
-            clean_line = line[1:].strip()
-            for pattern in patterns:
-                matches = re.findall(pattern, clean_line)
-                if matches:
-                    # Handle tuples from multiple capture groups
-                    for match in matches:
-                        if isinstance(match, tuple):
-                            # Take the last non-empty group
-                            name = next((m for m in reversed(match) if m), None)
-                            if name:
-                                added.append(clean_line)
-                                break
-                        else:
-                            added.append(clean_line)
-                            break
-    return added
-
-
-def test_coverage_agent(state: TestCoverageAgentState) -> TestCoverageAgentState:
+        return []
+
+    # Cheap substring check first: many patches contain no signature keyword at all
+    if not any(k in patch for k in config["keywords"]):
+        return []
+
+    return [match.group("line").strip() for match in config["added_signature_re"].finditer(patch)]
+
+
+async def _generate_tests(issue: Dict[str, Any], test_filename: str, prompt: str,
+                          semaphore: asyncio.Semaphore) -> None:
+    """
+    Generate a test stub with the LLM and attach it to a missing-tests issue.
+
+    Args:
+        issue (dict): The missing-tests finding, updated in place.
+        test_filename (str): Suggested path of the test file.
+        prompt (str): Test generation prompt for the file.
+        semaphore (asyncio.Semaphore): Bounds concurrent LLM requests.
+    """
+    try:
+        async with semaphore:
+            response = await llm.ainvoke([HumanMessage(content=prompt)])
+        issue["generated_tests"].append({
+            "filename": test_filename,
+            "code": response.content.strip()
+        })
+    except Exception as e:
+        print(f"❌ Test generation failed for {issue['filename']}: {e}")
+
+
+async def test_coverage_agent(state: TestCoverageAgentState) -> Dict[str, Any]:
     """
     Test Coverage Agent.
 
     Detects if new/changed code has corresponding tests.
-    Generates language-appropriate test stubs for missing tests.
+    Generates language-appropriate test stubs for missing tests. Stubs for
+    all files are generated concurrently, at most MAX_TEST_GEN_CONCURRENCY
+    LLM requests at a time.
 
     Args:
         state (TestCoverageAgentState): Current state with PR files and code review findings.
 
     Returns:
-        TestCoverageAgentState: Updated state with coverage findings.
+        dict: State update with 'coverage_findings'. Only the changed key is
+        returned because this node runs in parallel with code_review.
     """
     findings = []
+    # (issue, test_filename, prompt) for every file needing generated tests
+    pending: List[tuple] = []
 
-    # Group files by language to check for test files
+    # Which languages already have a test file modified in this PR. Those
+    # files are skipped before their patches are scanned for new functions.
     changed_files = [f["filename"] for f in state.files]
+    has_tests = {
+        ext: any(cfg["test_pattern_re"].search(fn) for fn in changed_files)
+        for ext, cfg in LANGUAGE_TEST_CONFIG.items()
+    }
     
     for f in state.files:
         filename = f["filename"]
         patch = f.get("patch", "")
         
         # Get language configuration
-        config = get_language_config(filename)
+        ext = os.path.splitext(filename)[1].lower()
+        config = _config_for_ext(ext)
         if not config:
             continue  # Skip unsupported file types
         
-        # Skip test files themselves
-        if re.search(config["test_pattern"], filename):
+        # Tests for this language were modified (this also covers test files themselves)
+        if has_tests[ext]:
             continue
         
         # Extract added functions/classes based on language
@@ -201,55 +249,49 @@ def test_coverage_agent(state: TestCoverageAgentState) -> TestCoverageAgentState
         if not added_entities:
             continue
         
-        # Check if there are test files for this language
-        test_files = [f for f in changed_files if re.search(config["test_pattern"], f)]
+        # Flag missing tests: added functions/classes but no test files modified
+        language = config["language"]
+        framework = config["framework"]
         
-        # Flag missing tests if there are added functions/classes but no test files modified
-        if not test_files:
-            language = config["language"]
-            framework = config["framework"]
-            
-            # Determine test file name based on language conventions
-            base_name = os.path.basename(filename)
-            name_without_ext = os.path.splitext(base_name)[0]
-            
-            if config.get("test_prefix"):
-                test_filename = f"{config['test_dir']}/{config['test_prefix']}{base_name}"
-            elif config.get("test_suffix"):
-                ext = os.path.splitext(filename)[1]
-                if config["test_suffix"].startswith("_") or config["test_suffix"].startswith("."):
-                    test_filename = f"{config['test_dir']}/{name_without_ext}{config['test_suffix']}"
-                else:
-                    test_filename = f"{config['test_dir']}/{name_without_ext}{config['test_suffix']}"
+        # Determine test file name based on language conventions
+        base_name = os.path.basename(filename)
+        name_without_ext = os.path.splitext(base_name)[0]
+        
+        if config.get("test_prefix"):
+            test_filename = f"{config['test_dir']}/{config['test_prefix']}{base_name}"
+        elif config.get("test_suffix"):
+            if config["test_suffix"].startswith("_") or config["test_suffix"].startswith("."):
+                test_filename = f"{config['test_dir']}/{name_without_ext}{config['test_suffix']}"
             else:
-                test_filename = f"{config['test_dir']}/test_{base_name}"
-            
-            issue = {
-                "filename": filename,
-                "issue": "Missing tests",
-                "message": f"New functions/classes added in {filename} but no test files were modified.",
-                "suggestion": f"Add unit tests using {framework} in {test_filename}",
-                "generated_tests": []
-            }
-
-            # --- Generate test stubs with LLM ---
-            prompt = PROMPT_TEMPLATE.format(
-                language=language,
-                framework=framework,
-                filename=filename,
-                added_entities='\n'.join(added_entities)
-            )
-
-            try:
-                response = llm.invoke([HumanMessage(content=prompt)])
-                issue["generated_tests"].append({
-                    "filename": test_filename,
-                    "code": response.content.strip()
-                })
-            except Exception as e:
-                print(f"❌ Test generation failed for {filename}: {e}")
-
-            findings.append(issue)
-
-    state.coverage_findings = findings
-    return state
\ No newline at end of file
+                test_filename = f"{config['test_dir']}/{name_without_ext}{config['test_suffix']}"
+        else:
+            test_filename = f"{config['test_dir']}/test_{base_name}"
+        
+        issue = {
+            "filename": filename,
+            "issue": "Missing tests",
+            "message": f"New functions/classes added in {filename} but no test files were modified.",
+            "suggestion": f"Add unit tests using {framework} in {test_filename}",
+            "generated_tests": []
+        }
+
+        # --- Generate test stubs with LLM ---
+        prompt = PROMPT_TEMPLATE.format(
+            language=language,
+            framework=framework,
+            filename=filename,
+            added_entities='\n'.join(added_entities)
+        )
+
+        pending.append((issue, test_filename, prompt))
+        findings.append(issue)
+
+    # --- Generate all test stubs concurrently ---
+    if pending:
+        semaphore = asyncio.Semaphore(MAX_TEST_GEN_CONCURRENCY)
+        await asyncio.gather(*(
+            _generate_tests(issue, test_filename, prompt, semaphore)
+            for issue, test_filename, prompt in pending
+        ))
+
+    return {"coverage_findings": findings}
\ No newline at end of file
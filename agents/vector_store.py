@@ -9,13 +9,34 @@ Stores and retrieves:
 
 import chromadb
 from chromadb.config import Settings
-from typing import List, Dict, Any, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
 from openai import OpenAI
+import hashlib
+import httpx
 import os
+import threading
 from dotenv import load_dotenv
+from agents.llm_client import HTTP2_AVAILABLE
+
+# Optional tokenizer for sizing guideline chunks in tokens rather than characters
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 load_dotenv()
 
+# Number of embeddings kept in memory (re-reviews and re-seeding reuse them)
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+
+# Target size of a guideline chunk in tokens (about 500 characters of prose)
+CHUNK_TOKENS = int(os.getenv("GUIDELINE_CHUNK_TOKENS", "128"))
+
+# Guideline chunks embedded and upserted per request
+UPSERT_BATCH_SIZE = int(os.getenv("GUIDELINE_UPSERT_BATCH", "64"))
+
 
 class VectorStore:
     """Vector database for storing and retrieving code review knowledge."""
@@ -41,10 +62,24 @@ class VectorStore:
         if not api_key:
             raise ValueError("EMBEDDING_API_KEY or OPENAI_API_KEY must be set in .env file")
         
-        self.openai_client = OpenAI(api_key=api_key, base_url=base_url)
+        # One pooled (HTTP/2 when available) connection for all embedding calls
+        self.openai_client = OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=httpx.Client(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+                timeout=httpx.Timeout(60.0, connect=5.0)
+            )
+        )
         self.embedding_model = "text-embedding-3-small"
         self.embedding_dimensions = 1536  # text-embedding-3-small default dimensions
         
+        # LRU cache of embeddings keyed by sha256(model:text)
+        self._embedding_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._embedding_cache_lock = threading.Lock()
+        self._encoding = None  # tiktoken encoding, loaded on first chunking (False: unavailable)
+        
         # Create or get collections
         self.rules_collection = self.client.get_or_create_collection(
             name="review_rules",
@@ -61,22 +96,54 @@ class VectorStore:
     def generate_embeddings(self, texts: List[str]) -> List[List[float]]:
         """Generate embeddings for a list of texts using OpenAI text-embedding-3-small.
         
+        Texts embedded before are served from an in-memory LRU cache; only the
+        rest are sent to the API, in one request with duplicates removed.
+        
         Args:
             texts: List of text strings to embed
             
         Returns:
             List of embedding vectors (1536 dimensions each)
         """
+        keys = [self._embedding_key(text) for text in texts]
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        with self._embedding_cache_lock:
+            for i, key in enumerate(keys):
+                cached = self._embedding_cache.get(key)
+                if cached is not None:
+                    self._embedding_cache.move_to_end(key)
+                    embeddings[i] = cached
+        
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if not misses:
+            return embeddings
+        
+        # Send each distinct text once, even if it repeats within the batch
+        unique_texts: Dict[str, str] = {}
+        for i in misses:
+            unique_texts.setdefault(keys[i], texts[i])
+        
         try:
             response = self.openai_client.embeddings.create(
                 model=self.embedding_model,
-                input=texts
+                input=list(unique_texts.values())
             )
-            embeddings = [item.embedding for item in response.data]
-            return embeddings
         except Exception as e:
             print(f"❌ Error generating embeddings: {e}")
             raise
+        
+        fresh = {key: item.embedding for key, item in zip(unique_texts, response.data)}
+        for i in misses:
+            embeddings[i] = fresh[keys[i]]
+        with self._embedding_cache_lock:
+            self._embedding_cache.update(fresh)
+            while len(self._embedding_cache) > EMBEDDING_CACHE_SIZE:
+                self._embedding_cache.popitem(last=False)
+        return embeddings
+    
+    def _embedding_key(self, text: str) -> str:
+        """Cache key for a text's embedding under the current model."""
+        return hashlib.sha256(f"{self.embedding_model}:{text}".encode("utf-8")).hexdigest()
     
     def store_review_rules(self, rules: List[Dict[str, Any]], source: str = "global"):
         """Store review rules in vector database.
@@ -85,7 +152,15 @@ class VectorStore:
             rules: List of rule dictionaries with keys: id, title, severity, description, fix
             source: Source of rules ("global" or "project")
         """
-        if not rules:
+        self.store_review_rules_batch([(rules, source)])
+    
+    def store_review_rules_batch(self, rule_sets: List[Tuple[List[Dict[str, Any]], str]]):
+        """Store several sets of review rules with one embedding call and one upsert.
+        
+        Args:
+            rule_sets: (rules, source) pairs, as for store_review_rules()
+        """
+        if not any(rules for rules, _ in rule_sets):
             print("⚠️ No rules to store")
             return
         
@@ -93,7 +168,7 @@ class VectorStore:
         metadatas = []
         ids = []
         
-        for rule in rules:
+        for rule, source in ((rule, source) for rules, source in rule_sets for rule in rules):
             rule_id = rule.get("id", "unknown")
             title = rule.get("title", "")
             description = rule.get("description", "")
@@ -106,29 +181,46 @@ class VectorStore:
             documents.append(doc_text)
             
             # Store metadata
-            metadatas.append({
+            metadata = {
                 "rule_id": rule_id,
                 "title": title,
                 "severity": severity,
                 "scope": scope,
                 "source": source,
                 "type": "review_rule"
-            })
+            }
+            # Fingerprint of everything stored for the rule, to skip unchanged ones on re-seed
+            metadata["content_hash"] = hashlib.sha256(
+                "\x00".join([self.embedding_model, doc_text] + [str(v) for v in metadata.values()]).encode("utf-8")
+            ).hexdigest()
+            metadatas.append(metadata)
             
             ids.append(f"{source}_{rule_id}")
         
+        # Skip rules already stored with identical content (no re-embedding)
+        existing = self.rules_collection.get(ids=ids, include=["metadatas"])
+        stored_hashes = {
+            rule_id: (meta or {}).get("content_hash")
+            for rule_id, meta in zip(existing["ids"], existing["metadatas"] or [])
+        }
+        changed = [i for i, rule_id in enumerate(ids) if stored_hashes.get(rule_id) != metadatas[i]["content_hash"]]
+        sources = ", ".join(source for rules, source in rule_sets if rules)
+        if not changed:
+            print(f"✓ {len(ids)} rules from {sources} already up to date")
+            return
+        
         # Generate embeddings
-        embeddings = self.generate_embeddings(documents)
+        embeddings = self.generate_embeddings([documents[i] for i in changed])
         
         # Store in ChromaDB
         self.rules_collection.upsert(
             embeddings=embeddings,
-            documents=documents,
-            metadatas=metadatas,
-            ids=ids
+            documents=[documents[i] for i in changed],
+            metadatas=[metadatas[i] for i in changed],
+            ids=[ids[i] for i in changed]
         )
         
-        print(f"✓ Stored {len(rules)} {source} rules")
+        print(f"✓ Stored {len(changed)} rules from {sources} ({len(ids) - len(changed)} unchanged)")
     
     def store_project_guidelines(self, content: str, filename: str, project_name: str = "default"):
         """Store user-provided project guidelines/documentation.
@@ -180,16 +272,23 @@ class VectorStore:
             print("⚠️ No valid chunks to store")
             return
         
-        # Generate embeddings
-        embeddings = self.generate_embeddings(documents)
-        
-        # Store in ChromaDB
-        self.guidelines_collection.upsert(
-            embeddings=embeddings,
-            documents=documents,
-            metadatas=metadatas,
-            ids=ids
-        )
+        # Embed and store in batches; the next batch is embedded while the
+        # current one is written to ChromaDB
+        batch_size = UPSERT_BATCH_SIZE
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(self.generate_embeddings, documents[:batch_size])
+            for start in range(0, len(documents), batch_size):
+                end = start + batch_size
+                embeddings = pending.result()
+                if end < len(documents):
+                    pending = executor.submit(self.generate_embeddings, documents[end:end + batch_size])
+                
+                self.guidelines_collection.upsert(
+                    embeddings=embeddings,
+                    documents=documents[start:end],
+                    metadatas=metadatas[start:end],
+                    ids=ids[start:end]
+                )
         
         print(f"✓ Stored {len(documents)} chunks from {filename}")
     
@@ -203,29 +302,21 @@ class VectorStore:
         Returns:
             List of relevant rules with metadata
         """
-        if not query.strip():
-            return []
-        
-        # Generate query embedding
-        query_embedding = self.generate_embeddings([query])[0]
-        
-        # Search in rules collection
-        results = self.rules_collection.query(
-            query_embeddings=[query_embedding],
-            n_results=n_results
-        )
-        
-        # Format results
-        relevant_rules = []
-        if results['documents'] and results['documents'][0]:
-            for i, doc in enumerate(results['documents'][0]):
-                relevant_rules.append({
-                    "content": doc,
-                    "metadata": results['metadatas'][0][i],
-                    "distance": results['distances'][0][i] if 'distances' in results else None
-                })
+        return self.search_relevant_rules_batch([query], n_results=n_results)[0]
+    
+    def search_relevant_rules_batch(self, queries: List[str], n_results: int = 5,
+                                    query_embeddings: Optional[List[List[float]]] = None) -> List[List[Dict[str, Any]]]:
+        """Search review rules for several queries with one embedding call and one query.
         
-        return relevant_rules
+        Args:
+            queries: Search queries
+            n_results: Number of results to return per query
+            query_embeddings: Precomputed embeddings for the non-blank queries (optional)
+            
+        Returns:
+            One list of relevant rules per query, in order (empty for blank queries)
+        """
+        return self._query_batch(self.rules_collection, queries, n_results, None, query_embeddings)
     
     def search_project_guidelines(self, query: str, project_name: Optional[str] = None, 
                                   owner: Optional[str] = None, n_results: int = 3) -> List[Dict[str, Any]]:
@@ -240,12 +331,24 @@ class VectorStore:
         Returns:
             List of relevant guideline chunks with metadata
         """
-        if not query.strip():
-            return []
-        
-        # Generate query embedding
-        query_embedding = self.generate_embeddings([query])[0]
+        return self.search_project_guidelines_batch([query], project_name=project_name,
+                                                    owner=owner, n_results=n_results)[0]
+    
+    def search_project_guidelines_batch(self, queries: List[str], project_name: Optional[str] = None,
+                                        owner: Optional[str] = None, n_results: int = 3,
+                                        query_embeddings: Optional[List[List[float]]] = None) -> List[List[Dict[str, Any]]]:
+        """Search project guidelines for several queries with one embedding call and one query.
         
+        Args:
+            queries: Search queries
+            project_name: Filter by full project name "owner/repo" (optional)
+            owner: Filter by GitHub owner/username (optional)
+            n_results: Number of results to return per query
+            query_embeddings: Precomputed embeddings for the non-blank queries (optional)
+            
+        Returns:
+            One list of relevant guideline chunks per query, in order (empty for blank queries)
+        """
         # Build filter based on provided parameters
         where = None
         if project_name:
@@ -253,59 +356,113 @@ class VectorStore:
         elif owner:
             where = {"owner": owner}
         
-        # Search in guidelines collection
-        results = self.guidelines_collection.query(
-            query_embeddings=[query_embedding],
+        return self._query_batch(self.guidelines_collection, queries, n_results, where, query_embeddings)
+    
+    def _query_batch(self, collection, queries: List[str], n_results: int,
+                     where: Optional[Dict[str, Any]],
+                     query_embeddings: Optional[List[List[float]]]) -> List[List[Dict[str, Any]]]:
+        """Run one Chroma query for all non-blank queries and split the results per query.
+        
+        Args:
+            collection: Chroma collection to search
+            queries: Search queries
+            n_results: Number of results to return per query
+            where: Metadata filter (optional)
+            query_embeddings: Precomputed embeddings for the non-blank queries (optional)
+            
+        Returns:
+            One list of matches per query, in order
+        """
+        matches: List[List[Dict[str, Any]]] = [[] for _ in queries]
+        indices = [i for i, query in enumerate(queries) if query.strip()]
+        if not indices:
+            return matches
+        
+        # Generate all query embeddings in a single request
+        if query_embeddings is None:
+            query_embeddings = self.generate_embeddings([queries[i] for i in indices])
+        
+        results = collection.query(
+            query_embeddings=query_embeddings,
             n_results=n_results,
             where=where
         )
         
         # Format results
-        relevant_guidelines = []
-        if results['documents'] and results['documents'][0]:
-            for i, doc in enumerate(results['documents'][0]):
-                relevant_guidelines.append({
+        documents = results['documents'] or []
+        for row, i in enumerate(indices):
+            if row >= len(documents):
+                break
+            for j, doc in enumerate(documents[row]):
+                matches[i].append({
                     "content": doc,
-                    "metadata": results['metadatas'][0][i],
-                    "distance": results['distances'][0][i] if 'distances' in results else None
+                    "metadata": results['metadatas'][row][j],
+                    "distance": results['distances'][row][j] if results.get('distances') else None
                 })
         
-        return relevant_guidelines
+        return matches
     
-    def _chunk_text(self, text: str, chunk_size: int = 500) -> List[str]:
+    def _chunk_text(self, text: str, chunk_tokens: int = CHUNK_TOKENS) -> List[str]:
         """Split text into chunks for embedding.
         
+        Paragraphs are packed greedily until the next one would exceed
+        chunk_tokens; a single longer paragraph becomes a chunk of its own.
+        
         Args:
             text: Text to chunk
-            chunk_size: Approximate size of each chunk in characters
+            chunk_tokens: Approximate size of each chunk in tokens
             
         Returns:
             List of text chunks
         """
-        # Split by double newlines (paragraphs) first
-        paragraphs = text.split('\n\n')
+        count_tokens = self._token_counter()
         
         chunks = []
-        current_chunk = ""
+        current: List[str] = []
+        current_tokens = 0
         
-        for para in paragraphs:
+        # Split by double newlines (paragraphs) first
+        for para in text.split('\n\n'):
             para = para.strip()
             if not para:
                 continue
             
-            # If adding this paragraph exceeds chunk size, save current and start new
-            if len(current_chunk) + len(para) > chunk_size and current_chunk:
-                chunks.append(current_chunk)
-                current_chunk = para
-            else:
-                current_chunk += ("\n\n" if current_chunk else "") + para
+            # If adding this paragraph exceeds the chunk size, save current and start new
+            para_tokens = count_tokens(para)
+            if current and current_tokens + para_tokens > chunk_tokens:
+                chunks.append("\n\n".join(current))
+                current = []
+                current_tokens = 0
+            current.append(para)
+            current_tokens += para_tokens
         
         # Add the last chunk
-        if current_chunk:
-            chunks.append(current_chunk)
+        if current:
+            chunks.append("\n\n".join(current))
         
         return chunks
     
+    def _token_counter(self):
+        """Return a function counting the embedding model's tokens in a text.
+        
+        Falls back to roughly 4 characters per token without tiktoken, or when
+        its encoding files cannot be loaded (e.g. offline hosts).
+        """
+        if self._encoding is None:
+            self._encoding = False
+            if tiktoken is not None:
+                try:
+                    self._encoding = tiktoken.encoding_for_model(self.embedding_model)
+                except Exception:
+                    try:
+                        self._encoding = tiktoken.get_encoding("cl100k_base")
+                    except Exception:
+                        pass
+        if not self._encoding:
+            return lambda text: len(text) // 4 + 1
+        encoding = self._encoding
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    
     def get_collection_stats(self) -> Dict[str, int]:
         """Get statistics about stored data.
         
@@ -318,12 +475,15 @@ class VectorStore:
         }
 
 
-# Singleton instance
+# Singleton instance (prompts are built from worker threads, so creation is locked)
 _vector_store = None
+_vector_store_lock = threading.Lock()
 
 def get_vector_store() -> VectorStore:
     """Get or create singleton vector store instance."""
     global _vector_store
     if _vector_store is None:
-        _vector_store = VectorStore()
+        with _vector_store_lock:
+            if _vector_store is None:
+                _vector_store = VectorStore()
     return _vector_store
@@ -1,13 +1,62 @@
+import hashlib
+import json
 import os
+import random
 import re
+import threading
 import time
 import math
 import requests
-from typing import List, Dict, Any, Optional, Union
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from typing import Iterator, List, Dict, Any, Optional, Tuple, Union
 from urllib.parse import urlparse, parse_qs
 
+# Optional faster JSON parser for large PR file listings (big patch strings)
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
 GITHUB_API = "https://api.github.com"
 
+# Path of a PR URL: /<owner>/<repo>/pull/<number>
+_PR_PATH_RE = re.compile(r"^/([^/]+)/([^/]+)/pull/(\d+)")
+
+# Shared keep-alive session: pages and PRs reuse the same TLS connections.
+# Retries stay in fetch_pr_files(), which also handles rate limits.
+_session = requests.Session()
+_session.headers.update({
+    "Accept": "application/vnd.github+json",
+    "X-GitHub-Api-Version": "2022-11-28",
+    "Accept-Encoding": "gzip, deflate",
+    "User-Agent": "pullpal",
+})
+_session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
+
+# Concurrent page requests for PRs with more than 100 files (kept low: GitHub's
+# secondary rate limits punish bursts of concurrent requests)
+GITHUB_PAGE_WORKERS = min(int(os.getenv("GITHUB_PAGE_WORKERS", "5")), 6)
+
+# Validators (ETag / Last-Modified), parsed body and last page number per
+# fetched page, kept in memory and on disk so they survive restarts.
+# Re-fetching an unchanged page is a conditional GET answered by an empty 304,
+# which GitHub does not count against the rate limit.
+# The disk cache holds file lists with patch content, including from private
+# repos (pages under their hash, and again as pr_files/*.json per head/base
+# commit): keep GITHUB_CACHE_DIR private. Files written longer ago than
+# GITHUB_CACHE_MAX_AGE_DAYS are deleted (checked at most once an hour).
+GITHUB_CACHE_DIR = Path(os.getenv("GITHUB_CACHE_DIR", "~/.pullpal/cache/github")).expanduser()
+GITHUB_CACHE_MAX_AGE_DAYS = float(os.getenv("GITHUB_CACHE_MAX_AGE_DAYS", "7"))
+_CACHE_PRUNE_INTERVAL = 3600
+_last_cache_prune = 0.0
+# Pages kept in memory (least recently used are evicted; the disk copy remains)
+GITHUB_MEMORY_CACHE_SIZE = int(os.getenv("GITHUB_MEMORY_CACHE_SIZE", "256"))
+_etag_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_etag_cache_lock = threading.Lock()
+
 
 def parse_github_pr_url(url: str) -> Dict[str, Union[str, int, None]]:
     """
@@ -23,11 +72,17 @@ def parse_github_pr_url(url: str) -> Dict[str, Union[str, int, None]]:
     if parsed.netloc != "github.com":
         raise ValueError("Invalid GitHub URL")
 
-    match = re.match(r"^/([^/]+)/([^/]+)/pull/(\d+)", parsed.path)
-    if not match:
-        raise ValueError("URL does not look like a PR link")
+    # Fast path for the plain /<owner>/<repo>/pull/<number>[/...] form
+    parts = parsed.path.split("/", 5)
+    if (len(parts) >= 5 and not parts[0] and parts[1] and parts[2]
+            and parts[3] == "pull" and parts[4].isascii() and parts[4].isdigit()):
+        owner, repo, pr_number = parts[1], parts[2], parts[4]
+    else:
+        match = _PR_PATH_RE.match(parsed.path)
+        if not match:
+            raise ValueError("URL does not look like a PR link")
 
-    owner, repo, pr_number = match.groups()
+        owner, repo, pr_number = match.groups()
     query_params = parse_qs(parsed.query)
 
     page = None
@@ -45,99 +100,320 @@ def parse_github_pr_url(url: str) -> Dict[str, Union[str, int, None]]:
     }
 
 
-def fetch_pr_files(
-    owner: str, repo: str, pr_number: int, token: Optional[str] = None
-) -> List[Dict[str, Any]]:
+def _backoff_delay(attempt: int, base: float = 1.0, cap: float = 15.0) -> float:
+    """Exponential backoff with full jitter: a random delay in [0, min(cap, base * 2**attempt))."""
+    return random.random() * min(cap, base * (2 ** attempt))
+
+
+def _throttle(resp: requests.Response) -> None:
     """
-    Fetch changed files from a GitHub Pull Request.
+    Spread the remaining requests over the time left when the rate limit runs low.
 
-    Args:
-        owner (str): Repository owner
-        repo (str): Repository name
-        pr_number (int): Pull request number
-        token (str, optional): GitHub personal access token for private repos
+    Once fewer than 10% of the hourly requests remain, each call waits
+    (seconds until reset) / (requests remaining), so a large PR slows down
+    instead of hitting the limit.
+    """
+    try:
+        remaining = int(resp.headers["X-RateLimit-Remaining"])
+        limit = int(resp.headers["X-RateLimit-Limit"])
+        reset_ts = int(resp.headers["X-RateLimit-Reset"])
+    except (KeyError, ValueError):
+        return
+    if 0 < remaining < limit * 0.1:
+        delay = max(0, reset_ts - int(time.time())) / remaining
+        if delay > 0:
+            time.sleep(min(delay, 60))
 
-    Returns:
-        List[Dict[str, Any]]: List of file information dictionaries
+
+def _get_with_retry(url: str, headers: Dict[str, str]) -> requests.Response:
     """
-    headers = {}
-    token = token or os.getenv("GITHUB_TOKEN")
-    if token:
-        headers["Authorization"] = f"token {token}"
+    GET a GitHub API URL, retrying with backoff and waiting out short rate limits.
 
-    files: List[Dict[str, Any]] = []
-    page = 1
+    Args:
+        url (str): API URL to fetch
+        headers (dict): Extra request headers (e.g. Authorization)
 
-    # Retry/backoff configuration
+    Returns:
+        requests.Response: The successful response
+    """
+    # Retry/backoff configuration (jittered so concurrent retries don't align)
     max_attempts = 4
-    base_backoff = 1.0  # seconds
     max_auto_wait = int(os.getenv("GITHUB_MAX_AUTO_WAIT", "300"))  # seconds
 
+    attempt = 0
     while True:
-        url = f"{GITHUB_API}/repos/{owner}/{repo}/pulls/{pr_number}/files?page={page}&per_page=100"
+        try:
+            resp = _session.get(url, headers=headers, timeout=30)
+        except requests.RequestException as e:
+            attempt += 1
+            if attempt >= max_attempts:
+                raise
+            time.sleep(_backoff_delay(attempt))
+            continue
 
-        attempt = 0
-        while True:
+        # Handle rate limit explicitly
+        if resp.status_code == 403 and "X-RateLimit-Remaining" in resp.headers:
+            remaining = resp.headers.get("X-RateLimit-Remaining")
+            reset_header = resp.headers.get("X-RateLimit-Reset")
             try:
-                resp = requests.get(url, headers=headers, timeout=30)
-            except requests.RequestException as e:
-                attempt += 1
-                if attempt >= max_attempts:
-                    raise
-                sleep = base_backoff * (2 ** (attempt - 1))
-                time.sleep(sleep)
-                continue
-
-            # Handle rate limit explicitly
-            if resp.status_code == 403 and "X-RateLimit-Remaining" in resp.headers:
-                remaining = resp.headers.get("X-RateLimit-Remaining")
-                reset_header = resp.headers.get("X-RateLimit-Reset")
+                reset_ts = int(reset_header) if reset_header else None
+            except Exception:
+                reset_ts = None
+
+            if remaining == "0" and reset_ts:
+                now_ts = int(time.time())
+                wait = max(0, reset_ts - now_ts)
+                # If wait is short, auto-sleep; otherwise surface helpful error
+                if wait <= max_auto_wait:
+                    print(f"GitHub rate limit reached; sleeping {wait}s until reset...")
+                    time.sleep(wait + 1)
+                    # after sleeping, retry the same page
+                    continue
+                else:
+                    reset_time_str = reset_header
+                    raise RuntimeError(
+                        f"GitHub API rate limit exceeded. Reset at {reset_time_str} (in ~{wait}s). "
+                        "Set a GITHUB_TOKEN environment variable to increase rate limits, or wait until reset."
+                    )
+
+        # For other 403/4xx/5xx errors, do exponential backoff a few times
+        if resp.status_code >= 400:
+            attempt += 1
+            if attempt >= max_attempts:
+                # Surface a useful message for 404/403
                 try:
-                    reset_ts = int(reset_header) if reset_header else None
+                    resp.raise_for_status()
                 except Exception:
-                    reset_ts = None
-
-                if remaining == "0" and reset_ts:
-                    now_ts = int(time.time())
-                    wait = max(0, reset_ts - now_ts)
-                    # If wait is short, auto-sleep; otherwise surface helpful error
-                    if wait <= max_auto_wait:
-                        print(f"GitHub rate limit reached; sleeping {wait}s until reset...")
-                        time.sleep(wait + 1)
-                        # after sleeping, retry the same page
-                        continue
-                    else:
-                        reset_time_str = reset_header
-                        raise RuntimeError(
-                            f"GitHub API rate limit exceeded. Reset at {reset_time_str} (in ~{wait}s). "
-                            "Set a GITHUB_TOKEN environment variable to increase rate limits, or wait until reset."
-                        )
-
-            # For other 403/4xx/5xx errors, do exponential backoff a few times
-            if resp.status_code >= 400:
-                attempt += 1
-                if attempt >= max_attempts:
-                    # Surface a useful message for 404/403
-                    try:
-                        resp.raise_for_status()
-                    except Exception:
-                        raise
-                sleep = base_backoff * (2 ** (attempt - 1))
-                time.sleep(sleep)
-                continue
-
-            # Success
-            break
+                    raise
+            # Secondary rate limits come with Retry-After; honour it when it is short
+            sleep = _backoff_delay(attempt)
+            retry_after = resp.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    sleep = min(float(retry_after), max_auto_wait) + random.random()
+                except ValueError:
+                    pass
+            time.sleep(sleep)
+            continue
+
+        # Success (including 304 Not Modified)
+        _throttle(resp)
+        return resp
+
+
+def _last_page(resp: requests.Response) -> Optional[int]:
+    """Return the page number of the Link rel="last" URL, or None if absent."""
+    last_url = resp.links.get("last", {}).get("url")
+    if not last_url:
+        return None
+    try:
+        return int(parse_qs(urlparse(last_url).query)["page"][0])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+
+def _load_cached_page(key: str) -> Optional[Dict[str, Any]]:
+    """Return the cached entry for a page key from memory or disk, or None."""
+    with _etag_cache_lock:
+        entry = _etag_cache.get(key)
+        if entry is not None:
+            _etag_cache.move_to_end(key)
+    if entry is not None:
+        return entry
+    try:
+        entry = _json_loads((GITHUB_CACHE_DIR / f"{key}.json").read_bytes())
+    except (OSError, ValueError):
+        return None
+    _remember_page(key, entry)
+    return entry
+
+
+def _remember_page(key: str, entry: Dict[str, Any]) -> None:
+    """Put a page entry in the in-memory LRU, evicting the oldest beyond its size."""
+    with _etag_cache_lock:
+        _etag_cache[key] = entry
+        _etag_cache.move_to_end(key)
+        while len(_etag_cache) > GITHUB_MEMORY_CACHE_SIZE:
+            _etag_cache.popitem(last=False)
+
+
+def _prune_disk_cache() -> None:
+    """Delete disk cache files older than GITHUB_CACHE_MAX_AGE_DAYS (at most hourly)."""
+    global _last_cache_prune
+    now = time.time()
+    with _etag_cache_lock:
+        if now - _last_cache_prune < _CACHE_PRUNE_INTERVAL:
+            return
+        _last_cache_prune = now
+
+    cutoff = now - GITHUB_CACHE_MAX_AGE_DAYS * 86400
+    for directory in (GITHUB_CACHE_DIR, GITHUB_CACHE_DIR / "pr_files"):
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+
+def _store_cached_page(key: str, entry: Dict[str, Any]) -> None:
+    """Keep a page entry in memory and write it to disk (best effort)."""
+    _remember_page(key, entry)
+    _prune_disk_cache()
+    try:
+        GITHUB_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = GITHUB_CACHE_DIR / f"{key}.{threading.get_ident()}.tmp"
+        tmp_path.write_text(json.dumps(entry), encoding="utf-8")
+        os.replace(tmp_path, GITHUB_CACHE_DIR / f"{key}.json")
+    except OSError as e:
+        print(f"⚠️ Could not write GitHub cache: {e}")
+
+
+def _fetch_page(url: str, headers: Dict[str, str]) -> Tuple[Any, Optional[int]]:
+    """
+    Fetch one GitHub API resource (e.g. a page of a list), revalidating cached copies.
 
-        data = resp.json()
+    Args:
+        url (str): API URL of the page
+        headers (dict): Extra request headers (e.g. Authorization)
+
+    Returns:
+        tuple: (parsed JSON body, last page number from the Link header or None)
+    """
+    # Responses depend on who asks, so the token is part of the key
+    key = hashlib.sha256(f"{url}\n{headers.get('Authorization', '')}".encode("utf-8")).hexdigest()
+    cached = _load_cached_page(key)
+
+    request_headers = dict(headers)
+    if cached:
+        if cached.get("etag"):
+            request_headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            request_headers["If-Modified-Since"] = cached["last_modified"]
+
+    resp = _get_with_retry(url, request_headers)
+    if resp.status_code == 304 and cached:
+        return cached["body"], cached.get("last_page")
+
+    data = _json_loads(resp.content)
+    last_page = _last_page(resp)
+    etag = resp.headers.get("ETag")
+    last_modified = resp.headers.get("Last-Modified")
+    if etag or last_modified:
+        _store_cached_page(key, {
+            "etag": etag,
+            "last_modified": last_modified,
+            "body": data,
+            "last_page": last_page,
+        })
+    return data, last_page
+
+
+def _auth_headers(token: Optional[str]) -> Dict[str, str]:
+    """Build request headers for the given token (or GITHUB_TOKEN from the environment)."""
+    token = token or os.getenv("GITHUB_TOKEN")
+    return {"Authorization": f"token {token}"} if token else {}
+
+
+def iter_pr_file_pages(
+    owner: str, repo: str, pr_number: int, token: Optional[str] = None
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Lazily yield the changed files of a GitHub Pull Request, one page at a time.
+
+    The first page tells (via the Link header) how many pages there are; the
+    remaining pages are then fetched concurrently and yielded in order as they
+    arrive. Without a Link header the pages are walked one by one.
+
+    Args:
+        owner (str): Repository owner
+        repo (str): Repository name
+        pr_number (int): Pull request number
+        token (str, optional): GitHub personal access token for private repos
+
+    Yields:
+        List[Dict[str, Any]]: File information dictionaries of one page (up to 100)
+    """
+    headers = _auth_headers(token)
+    base_url = f"{GITHUB_API}/repos/{owner}/{repo}/pulls/{pr_number}/files?per_page=100"
+
+    data, last_page = _fetch_page(f"{base_url}&page=1", headers)
+    if data:
+        yield data
+    if len(data) < 100:
+        return
+
+    if last_page and last_page > 1:
+        # Pages are independent once the count is known; keep the pool small
+        # to stay clear of GitHub's secondary rate limits
+        urls = [f"{base_url}&page={page}" for page in range(2, last_page + 1)]
+        with ThreadPoolExecutor(max_workers=GITHUB_PAGE_WORKERS) as executor:
+            for data, _ in executor.map(lambda url: _fetch_page(url, headers), urls):
+                yield data
+        return
+
+    # No Link header: walk the pages sequentially
+    page = 2
+    while True:
+        data, _ = _fetch_page(f"{base_url}&page={page}", headers)
         if not data:
             break
 
-        files.extend(data)
+        yield data
         if len(data) < 100:
             break
         page += 1
 
+
+def fetch_pr_files(
+    owner: str, repo: str, pr_number: int, token: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """
+    Fetch changed files from a GitHub Pull Request.
+
+    Files are saved per (head, base) commit pair, so re-running a review of
+    an unchanged PR reads them from disk after a single conditional request.
+
+    Args:
+        owner (str): Repository owner
+        repo (str): Repository name
+        pr_number (int): Pull request number
+        token (str, optional): GitHub personal access token for private repos
+
+    Returns:
+        List[Dict[str, Any]]: List of file information dictionaries
+    """
+    # The file list only changes with the PR's head/base commits: look those up
+    # (a conditional GET, usually a free 304) and reuse the files saved for them
+    headers = _auth_headers(token)
+    pr_data, _ = _fetch_page(f"{GITHUB_API}/repos/{owner}/{repo}/pulls/{pr_number}", headers)
+    head_sha = (pr_data.get("head") or {}).get("sha")
+    base_sha = (pr_data.get("base") or {}).get("sha")
+    cache_path = None
+    if head_sha and base_sha:
+        cache_path = GITHUB_CACHE_DIR / "pr_files" / f"{owner}_{repo}_{pr_number}_{head_sha}_{base_sha}.json"
+        try:
+            return _json_loads(cache_path.read_bytes())
+        except (OSError, ValueError):
+            pass
+
+    files: List[Dict[str, Any]] = []
+    for page in iter_pr_file_pages(owner, repo, pr_number, token):
+        files.extend(page)
+
+    if cache_path is not None:
+        _prune_disk_cache()
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp_path.write_text(json.dumps(files), encoding="utf-8")
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"⚠️ Could not write GitHub cache: {e}")
     return files
 
 
@@ -151,18 +427,20 @@ def parse_pr_files(files: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     Returns:
         List[Dict]: Parsed file info
     """
-    return [
-        {
-            "filename": f.get("filename"),
-            "status": f.get("status"),
-            "additions": f.get("additions", 0),
-            "deletions": f.get("deletions", 0),
-            "changes": f.get("changes", 0),
-            "patch": f.get("patch", ""),   # may be missing for binary/large files
+    parsed: List[Dict[str, Any]] = []
+    append = parsed.append
+    for f in files:
+        get = f.get  # bound once per file instead of per key
+        append({
+            "filename": get("filename"),
+            "status": get("status"),
+            "additions": get("additions", 0),
+            "deletions": get("deletions", 0),
+            "changes": get("changes", 0),
+            "patch": get("patch", ""),   # may be missing for binary/large files
             "truncated": "patch" not in f,
-        }
-        for f in files
-    ]
+        })
+    return parsed
 
 # for testing this file
 
@@ -8,8 +8,15 @@ Loads:
 
 import json
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+# Optional faster JSON parser for large rule files
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
 # Add parent directory to path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
@@ -19,8 +26,7 @@ from agents.vector_store import get_vector_store
 def load_global_rules(rules_path: Path) -> list:
     """Load global review rules from JSON file."""
     try:
-        with rules_path.open('r', encoding='utf-8') as f:
-            rules = json.load(f)
+        rules = _json_loads(rules_path.read_bytes())
         print(f"✓ Loaded {len(rules)} global rules from {rules_path.name}")
         return rules
     except Exception as e:
@@ -44,33 +50,54 @@ def load_extended_rules(rules_path: Path) -> str:
         return ""
 
 
+def load_knowledge_file(path: Path) -> tuple:
+    """Load one knowledge base file.
+
+    Returns:
+        (path, kind, data): kind is "rules" (list of rules), "guidelines"
+        (markdown text) or None for unsupported files.
+    """
+    if path.suffix == ".json":
+        print(f"📋 Loading rules from {path.name}...")
+        return path, "rules", load_global_rules(path)
+    if path.suffix == ".md":
+        print(f"📖 Loading guidelines from {path.name}...")
+        return path, "guidelines", load_extended_rules(path)
+    return path, None, None
+
+
 def main():
     """Seed the vector database with initial knowledge."""
     print("\n" + "="*60)
     print("🌱 Seeding Knowledge Base")
     print("="*60 + "\n")
     
-    # Initialize vector store
-    vector_store = get_vector_store()
-    
     # Get knowledge_base directory
     kb_dir = Path(__file__).parent.parent / "knowledge_base"
     print(f"\n🔍 Scanning {kb_dir} for rule files...")
-    for rule_file in kb_dir.glob("*"):
-        if rule_file.suffix == ".json":
-            print(f"\n📋 Loading rules from {rule_file.name}...")
-            rules = load_global_rules(rule_file)
-            if rules:
-                vector_store.store_review_rules(rules, source=rule_file.name)
-        elif rule_file.suffix == ".md":
-            print(f"\n📖 Loading guidelines from {rule_file.name}...")
-            content = load_extended_rules(rule_file)
-            if content:
-                vector_store.store_project_guidelines(
-                    content=content,
-                    filename=rule_file.name,
-                    project_name="system"
-                )
+    
+    # Read and parse every file in parallel while the vector store initializes
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        loaded = executor.map(load_knowledge_file, sorted(kb_dir.glob("*")))
+        vector_store = get_vector_store()
+        loaded = list(loaded)
+    
+    rule_sets = []
+    for rule_file, kind, data in loaded:
+        if kind == "rules" and data:
+            rule_sets.append((data, rule_file.name))
+        elif kind == "guidelines" and data:
+            print(f"\n📖 Storing guidelines from {rule_file.name}...")
+            vector_store.store_project_guidelines(
+                content=data,
+                filename=rule_file.name,
+                project_name="system"
+            )
+    
+    # Embed and store the rules of every file in one batch
+    if rule_sets:
+        print(f"\n📋 Storing rules from {len(rule_sets)} file(s)...")
+        vector_store.store_review_rules_batch(rule_sets)
     
     # Show statistics
     print("\n" + "="*60)
@@ -3,6 +3,7 @@ Test script to verify RAG system is working correctly.
 """
 
 import sys
+from importlib.util import find_spec
 from pathlib import Path
 
 # Add parent directory to path
@@ -14,17 +15,16 @@ def test_imports():
     print("🧪 Testing RAG Imports")
     print("="*60)
     
-    try:
-        import chromadb
-        print("✓ chromadb imported")
-    except ImportError:
+    # find_spec() checks availability without paying the packages' import time
+    if find_spec("chromadb") is not None:
+        print("✓ chromadb available")
+    else:
         print("❌ chromadb not found. Install: pip install chromadb>=0.4.22")
         return False
     
-    try:
-        import sentence_transformers
-        print("✓ sentence_transformers imported")
-    except ImportError:
+    if find_spec("sentence_transformers") is not None:
+        print("✓ sentence_transformers available")
+    else:
         print("❌ sentence_transformers not found. Install: pip install sentence-transformers>=2.2.2")
         return False
     
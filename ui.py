@@ -1,11 +1,211 @@
+import asyncio
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional
+
 import streamlit as st
+from dotenv import load_dotenv
 from github_fetcher import parse_github_pr_url
-from agent_orchestration import workflow
-from agents.state import PRSummaryAgentState
+
+if TYPE_CHECKING:
+    from agents.state import PRSummaryAgentState
+
+# The agents load .env on import, but they are now imported lazily and
+# GITHUB_TOKEN is read before that
+load_dotenv()
 
 st.set_page_config(page_title="🛠 PR Review Agent", layout="wide")
 st.title("🛠 PR Review Agent")
 
+# File extension -> st.code language for highlighting code snippets
+LANG_MAP = {
+    '.py': 'python', '.java': 'java', '.js': 'javascript',
+    '.ts': 'typescript', '.go': 'go', '.rb': 'ruby',
+    '.php': 'php', '.cs': 'csharp', '.cpp': 'cpp',
+    '.c': 'c', '.rs': 'rust', '.kt': 'kotlin'
+}
+
+
+@st.cache_resource
+def get_workflow():
+    """Import and compile the review graph on first use.
+
+    The import pulls in LangGraph, the LLM clients and the RAG stack, so it is
+    deferred until a review starts instead of slowing every idle rerun.
+    """
+    from agent_orchestration import workflow
+    return workflow
+
+
+@st.cache_resource
+def get_review_executor() -> ThreadPoolExecutor:
+    """Worker threads running reviews off the script thread (shared across reruns)."""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="review")
+
+
+async def run_workflow(workflow, state: "PRSummaryAgentState", progress: list, summary_parts: list) -> dict:
+    """Run the review graph, listing each reviewed file as soon as it finishes.
+
+    Runs on a worker thread, so progress lines and the pieces of the PR summary
+    (as the LLM generates them) are collected in lists and rendered by the
+    script thread on its next rerun.
+    """
+    result = {}
+    async for mode, chunk in workflow.astream(state, stream_mode=["custom", "values"]):
+        if mode == "custom" and "file_findings" in chunk:
+            reviewed = chunk["file_findings"]
+            count = len(reviewed["issues"])
+            progress.append(f"📄 Reviewed `{reviewed['filename']}`: {count} issue{'s' if count != 1 else ''}")
+        elif mode == "custom" and "summary_delta" in chunk:
+            summary_parts.append(chunk["summary_delta"])
+        elif mode == "values":
+            result = chunk
+    return result
+
+
+# Finished reviews are reused for this many seconds per (PR URL, token, guidelines)
+REVIEW_CACHE_TTL = 600
+
+
+@st.cache_resource
+def get_review_cache() -> dict:
+    """Finished review results shared across reruns: cache key -> (finish time, result).
+
+    Only touched from the script thread, before a review is submitted and once
+    its future is done, so worker threads never call Streamlit APIs.
+    """
+    return {}
+
+
+def review_cache_key(pr_url: str, token: Optional[str], guidelines: Optional[str]) -> str:
+    """Hash the review inputs (the token is not kept in clear in the cache)."""
+    return hashlib.sha256("\x00".join((pr_url, token or "", guidelines or "")).encode()).hexdigest()
+
+
+def cached_review(cache_key: str) -> Optional[dict]:
+    """Return the cached result for the given key, or None if missing or expired."""
+    entry = get_review_cache().get(cache_key)
+    if entry and time.time() - entry[0] < REVIEW_CACHE_TTL:
+        return entry[1]
+    return None
+
+
+def store_review(cache_key: str, result: dict) -> None:
+    """Cache a finished review result, dropping expired entries."""
+    cache = get_review_cache()
+    now = time.time()
+    for key, (finished, _) in list(cache.items()):
+        if now - finished >= REVIEW_CACHE_TTL:
+            cache.pop(key, None)
+    cache[cache_key] = (now, result)
+
+
+def run_review(workflow, pr_url: str, token: Optional[str], guidelines: Optional[str],
+               progress: list, summary_parts: list) -> dict:
+    """Executor entry point: run the async workflow on the worker thread's own loop."""
+    from agents.state import PRSummaryAgentState
+
+    pr_info = parse_github_pr_url(pr_url)
+    state = PRSummaryAgentState(pr_url=pr_url, custom_guidelines=guidelines)
+    state.github_token = token
+    state.guideline_text = guidelines
+    # Store full project identifier (owner/repo format)
+    state.project_name = f"{pr_info['owner']}/{pr_info['repo']}"
+    return dict(asyncio.run(run_workflow(workflow, state, progress, summary_parts)))
+
+
+# Result sections are fragments: buttons inside them (e.g. "Clear Issue") rerun
+# only their own section with the stored result instead of the whole script.
+@st.fragment
+def render_findings(result: dict) -> None:
+    """Render the code review findings of a review result."""
+    st.subheader("📝 Code Review Findings")
+    findings = result['findings']
+    if findings:
+        for f in findings:
+            # Syntax highlighting language, shared by all issues of the file
+            _, ext = os.path.splitext(f['filename'])
+            language = LANG_MAP.get(ext.lower(), 'text')
+            with st.expander(f"📄 {f['filename']} ({len(f['issues'])} issue{'s' if len(f['issues']) != 1 else ''})"):
+                for idx, issue in enumerate(f["issues"], 1):
+                    # Issue header with badge
+                    issue_type = issue['type'].upper()
+                    type_color = {
+                        'BUG': '🐛',
+                        'SECURITY': '🔒',
+                        'PERFORMANCE': '⚡',
+                        'STYLE': '💅'
+                    }.get(issue_type, '📌')
+                    source_label = {
+                        'global': '🌐 Global Rule',
+                        'user': '👤 User Rule',
+                        'rag': '📚 RAG Rule'
+                    }.get(issue.get('source', 'global'), '🌐 Global Rule')
+                    st.markdown(f"### {type_color} Issue #{idx}: {issue_type} [{source_label}]")
+                    # Display line numbers if available
+                    if 'line_start' in issue and issue.get('line_start'):
+                        if issue.get('line_end') and issue['line_end'] != issue['line_start']:
+                            st.caption(f"📍 Lines {issue['line_start']}-{issue['line_end']}")
+                        else:
+                            st.caption(f"📍 Line {issue['line_start']}")
+                    # Display code snippet if available
+                    if 'code_snippet' in issue and issue.get('code_snippet'):
+                        st.markdown("**Code:**")
+                        st.code(issue['code_snippet'], language=language)
+                    # LLM/user text goes through st.text: no markdown/HTML parsing
+                    st.markdown("**Issue:**")
+                    st.text(issue['message'])
+                    st.markdown("💡 **Suggestion:**")
+                    st.text(issue['suggestion'])
+                    # Show detailed rule info if available
+                    if issue.get('rule_id') or issue.get('rule_title'):
+                        st.markdown("---")
+                        st.markdown(f"**Rule ID:** {issue.get('rule_id', 'N/A')}")
+                        st.markdown(f"**Rule Title:** {issue.get('rule_title', 'N/A')}")
+                        st.markdown("**Rule Description:**")
+                        st.text(issue.get('rule_description', 'N/A'))
+                        st.markdown("**Rule Fix:**")
+                        st.text(issue.get('rule_fix', 'N/A'))
+                    # Add a clear button for each issue (for demonstration, does not persist)
+                    if st.button(f"Clear Issue #{idx} [{source_label}]", key=f"clear_{f['filename']}_{idx}"):
+                        st.success(f"Issue #{idx} cleared!")
+                    if idx < len(f['issues']):
+                        st.divider()
+    else:
+        st.info("✅ No code review issues detected.")
+
+
+@st.fragment
+def render_coverage(result: dict) -> None:
+    """Render the test coverage findings of a review result."""
+    st.subheader("🧪 Test Coverage Findings")
+    coverage_findings = result['coverage_findings']
+    if coverage_findings:
+        for f in coverage_findings:
+            with st.expander(f"{f['filename']} ({len(f.get('generated_tests',[]))} test stubs)"):
+                st.markdown(f"**Issue:** {f['issue']}")
+                st.markdown(f"**Message:** {f['message']}")
+                st.markdown(f"*Suggestion:* {f['suggestion']}")
+                for t in f.get("generated_tests", []):
+                    st.markdown(f"**Generated Test File:** {t['filename']}")
+                    st.code(t["code"], language="python")
+    else:
+        st.info("✅ No missing tests detected.")
+
+
+@st.fragment
+def render_summary(result: dict) -> None:
+    """Render the PR summary of a review result."""
+    st.subheader("🖊 PR Summary")
+    pr_summary = getattr(result, "pr_summary", None) or result.get("pr_summary", "")
+    if pr_summary:
+        st.success(pr_summary)
+    else:
+        st.warning("PR summary not available.")
+
+
 # --------------------------
 # Step 1: Input PR URL
 # --------------------------
@@ -15,10 +215,10 @@ pr_url = st.text_input(
 )
 
 # --------------------------
-# Step 1b: GitHub Personal Access Token (optional)
+# Step 1b: GitHub Personal Access Token (falls back to GITHUB_TOKEN)
 # --------------------------
 token = st.text_input(
-    "GitHub Personal Access Token (for private repos)",
+    "GitHub Personal Access Token (required unless GITHUB_TOKEN is set on the server)",
     placeholder="ghp_xxxxxxx",
     type="password"
 )
@@ -34,24 +234,30 @@ guideline_file = st.file_uploader(
 # --------------------------
 # Step 1d: Start Review Button
 # --------------------------
-if st.button("🚀 Start PR Review") and pr_url:
+if st.button("🚀 Start PR Review") and pr_url and not st.session_state.get("review_running"):
+    # Anonymous GitHub requests are limited to 60/hr per IP, shared by every user
+    # of this server; authenticated ones get 5000/hr per token
+    effective_token = token or os.getenv("GITHUB_TOKEN")
+    if not effective_token:
+        st.error("❌ A GitHub token is required — anonymous requests are capped at 60/hr per IP")
+        st.stop()
+
     try:
-        # Parse PR URL & initialize state
+        # Parse PR URL & read the workflow inputs
         pr_info = parse_github_pr_url(pr_url)
-        custom_guidelines = guideline_file.read().decode("utf-8") if guideline_file else None
-        state = PRSummaryAgentState(pr_url=pr_url, custom_guidelines=custom_guidelines)
-        state.github_token = token if token else None
-        # Store full project identifier (owner/repo format)
-        state.project_name = f"{pr_info['owner']}/{pr_info['repo']}"
-
-        # Read guideline file content (if provided)
-        if guideline_file is not None:
-            guideline_bytes = guideline_file.getvalue()
-            try:
-                guideline_content = guideline_bytes.decode("utf-8", errors="ignore")
-                state.guideline_text = guideline_content
-                
-                # 🆕 Store in RAG vector database
+        # Read the guideline upload once; the same text feeds the review and RAG
+        guideline_bytes = guideline_file.getvalue() if guideline_file else b""
+        guideline_content = guideline_bytes.decode("utf-8", errors="ignore") if guideline_bytes else None
+
+        if guideline_content is not None:
+            # 🆕 Store in RAG vector database (skipped when this session
+            # already stored the same file for the same project)
+            project_name = f"{pr_info['owner']}/{pr_info['repo']}"
+            guideline_key = hashlib.sha256(
+                guideline_bytes + guideline_file.name.encode() + project_name.encode()
+            ).hexdigest()
+            stored_guideline_hashes = st.session_state.setdefault("stored_guideline_hashes", set())
+            if guideline_key not in stored_guideline_hashes:
                 try:
                     from agents.vector_store import get_vector_store
                     with st.spinner(f"📝 Storing {guideline_file.name} in RAG database..."):
@@ -60,113 +266,89 @@ if st.button("🚀 Start PR Review") and pr_url:
                         vector_store.store_project_guidelines(
                             content=guideline_content,
                             filename=guideline_file.name,
-                            project_name=f"{pr_info['owner']}/{pr_info['repo']}"
+                            project_name=project_name
                         )
+                    stored_guideline_hashes.add(guideline_key)
                     st.success(f"✅ Guidelines stored in RAG: {guideline_file.name}")
                 except ImportError:
                     st.warning("⚠️ RAG not available (install: pip install chromadb sentence-transformers)")
                 except Exception as e:
                     st.warning(f"⚠️ Could not store in RAG: {e}")
-            except Exception:
-                # Fallback: best-effort decoding
-                state.guideline_text = guideline_bytes.decode(errors="ignore")
 
-        with st.spinner("Fetching PR and analyzing... This may take a few seconds"):
-            result = workflow.invoke(state)
+        # Same PR, token and guidelines reviewed recently: reuse that result
+        cache_key = review_cache_key(pr_url, effective_token, guideline_content)
+        cached = cached_review(cache_key)
+        if cached is not None:
+            st.session_state[f"result:{pr_url}"] = cached
+        else:
+            # Load the graph here so import errors surface on the page
+            workflow = get_workflow()
 
-        # --------------------------
-        # PR Overview
-        # --------------------------
-        st.subheader("📄 PR Overview")
-        col1, col2, col3, col4 = st.columns(4)
-        col1.markdown(f"**👤 Owner:** {result['owner']}")
-        col1.markdown(f"**📦 Repo:** {result['repo']}")
-        col2.markdown(f"**#️⃣ PR Number:** {result['pr_number']}")
-        col2.markdown(f"**📝 Files Changed:** {len(result['files'])}")
+            # Hand the review to a worker thread and poll it from the reruns below
+            progress = []
+            summary_parts = []
+            st.session_state["review_progress"] = progress
+            st.session_state["review_summary_parts"] = summary_parts
+            st.session_state["review_pr_url"] = pr_url
+            st.session_state["review_cache_key"] = cache_key
+            st.session_state["review_future"] = get_review_executor().submit(
+                run_review, workflow, pr_url, effective_token, guideline_content, progress, summary_parts
+            )
+            st.session_state["review_running"] = True
+    except Exception as e:
+        st.error(f"❌ Error processing PR: {e}")
+    else:
+        st.rerun()
 
-        # --------------------------
-        # Code Review Findings
-        # --------------------------
-        st.subheader("📝 Code Review Findings")
-        if result['findings']:
-            for f in result['findings']:
-                with st.expander(f"📄 {f['filename']} ({len(f['issues'])} issue{'s' if len(f['issues']) != 1 else ''})"):
-                    for idx, issue in enumerate(f["issues"], 1):
-                        # Issue header with badge
-                        issue_type = issue['type'].upper()
-                        type_color = {
-                            'BUG': '🐛',
-                            'SECURITY': '🔒',
-                            'PERFORMANCE': '⚡',
-                            'STYLE': '💅'
-                        }.get(issue_type, '📌')
-                        source_label = {
-                            'global': '🌐 Global Rule',
-                            'user': '👤 User Rule',
-                            'rag': '📚 RAG Rule'
-                        }.get(issue.get('source', 'global'), '🌐 Global Rule')
-                        st.markdown(f"### {type_color} Issue #{idx}: {issue_type} [{source_label}]")
-                        # Display line numbers if available
-                        if 'line_start' in issue and issue.get('line_start'):
-                            if issue.get('line_end') and issue['line_end'] != issue['line_start']:
-                                st.caption(f"📍 Lines {issue['line_start']}-{issue['line_end']}")
-                            else:
-                                st.caption(f"📍 Line {issue['line_start']}")
-                        # Display code snippet if available
-                        if 'code_snippet' in issue and issue.get('code_snippet'):
-                            st.markdown("**Code:**")
-                            import os
-                            _, ext = os.path.splitext(f['filename'])
-                            lang_map = {
-                                '.py': 'python', '.java': 'java', '.js': 'javascript',
-                                '.ts': 'typescript', '.go': 'go', '.rb': 'ruby',
-                                '.php': 'php', '.cs': 'csharp', '.cpp': 'cpp',
-                                '.c': 'c', '.rs': 'rust', '.kt': 'kotlin'
-                            }
-                            language = lang_map.get(ext.lower(), 'text')
-                            st.code(issue['code_snippet'], language=language)
-                        st.markdown(f"**Issue:** {issue['message']}")
-                        st.info(f"💡 **Suggestion:** {issue['suggestion']}")
-                        # Show detailed rule info if available
-                        if issue.get('rule_id') or issue.get('rule_title'):
-                            st.markdown("---")
-                            st.markdown(f"**Rule ID:** {issue.get('rule_id', 'N/A')}")
-                            st.markdown(f"**Rule Title:** {issue.get('rule_title', 'N/A')}")
-                            st.markdown(f"**Rule Description:** {issue.get('rule_description', 'N/A')}")
-                            st.markdown(f"**Rule Fix:** {issue.get('rule_fix', 'N/A')}")
-                        # Add a clear button for each issue (for demonstration, does not persist)
-                        if st.button(f"Clear Issue #{idx} [{source_label}]", key=f"clear_{f['filename']}_{idx}"):
-                            st.success(f"Issue #{idx} cleared!")
-                        if idx < len(f['issues']):
-                            st.divider()
-        else:
-            st.info("✅ No code review issues detected.")
+# --------------------------
+# Step 2: Poll the running review
+# --------------------------
+review_future = st.session_state.get("review_future")
+if review_future is not None and not review_future.done():
+    with st.status("Fetching PR and analyzing... This may take a few seconds", state="running"):
+        for line in st.session_state.get("review_progress", []):
+            st.write(line)
+        summary_draft = "".join(st.session_state.get("review_summary_parts", []))
+        if summary_draft:
+            st.markdown("🖊 **PR Summary (writing...)**")
+            st.text(summary_draft)
+    time.sleep(0.5)
+    st.rerun()
 
-        # --------------------------
-        # Test Coverage Findings
-        # --------------------------
-        st.subheader("🧪 Test Coverage Findings")
-        if result['coverage_findings']:
-            for f in result['coverage_findings']:
-                with st.expander(f"{f['filename']} ({len(f.get('generated_tests',[]))} test stubs)"):
-                    st.markdown(f"**Issue:** {f['issue']}")
-                    st.markdown(f"**Message:** {f['message']}")
-                    st.markdown(f"*Suggestion:* {f['suggestion']}")
-                    for t in f.get("generated_tests", []):
-                        st.markdown(f"**Generated Test File:** {t['filename']}")
-                        st.code(t["code"], language="python")
-        else:
-            st.info("✅ No missing tests detected.")
+# --------------------------
+# Step 3: Render the review result
+# --------------------------
+# Results are kept per PR URL, so reruns (widget clicks, re-uploads) render
+# them again without recomputing, and switching back to a PR shows its review
+if review_future is not None:
+    st.session_state["review_running"] = False
+    del st.session_state["review_future"]
+    try:
+        review_result = review_future.result()
+        st.session_state[f"result:{st.session_state['review_pr_url']}"] = review_result
+        store_review(st.session_state["review_cache_key"], review_result)
+    except Exception as e:
+        st.error(f"❌ Error processing PR: {e}")
+
+result = st.session_state.get(f"result:{pr_url}")
+if result:
+    try:
 
         # --------------------------
-        # PR Summary
+        # PR Overview
         # --------------------------
-        st.subheader("🖊 PR Summary")
-        pr_summary = getattr(result, "pr_summary", None) or result.get("pr_summary", "")
-        if pr_summary:
-            st.success(pr_summary)
-        else:
-            st.warning("PR summary not available.")
+        st.subheader("📄 PR Overview")
+        for col, (label, value) in zip(st.columns(4), (
+            ("👤 Owner", result['owner']),
+            ("📦 Repo", result['repo']),
+            ("#️⃣ PR Number", result['pr_number']),
+            ("📝 Files Changed", len(result['files'])),
+        )):
+            col.metric(label, value)
+
+        render_findings(result)
+        render_coverage(result)
+        render_summary(result)
 
     except Exception as e:
         st.error(f"❌ Error processing PR: {e}")
\ No newline at end of file